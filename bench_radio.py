@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Benchmarks de radio.py sin mpv ni red.
+
+Levanta un servidor falso de IPC JSON de MPV en un socket Unix temporal y
+sustituye YTMusic por un fixture con latencia inyectada; mide el camino real
+de radio.py (MpvPlayer, TrackQueue, RadioSession...) y escribe los resultados
+en JSON para comparar ejecuciones:
+
+    python bench_radio.py --latency 0.05 > antes.json
+
+Métricas:
+- time_to_first_loadfile_ms: desde la búsqueda hasta que MPV recibe el primer loadfile
+- enqueue: pistas/s al cargar colas de 50, 500 y 5000 canciones
+- track_change_to_notification_ms: del cambio de pista en MPV al envío de la notificación
+- idle_wakeups_per_s: cambios de contexto voluntarios del proceso con la radio sonando y sin eventos
+"""
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import threading
+import argparse
+import contextlib
+import statistics
+
+import radio
+
+class FakeMpv:
+    """Servidor mínimo de IPC JSON de MPV: playlist, propiedades observadas y eventos."""
+
+    def __init__(self, path):
+        self.path = path
+        self.playlist = []
+        self.pos = -1
+        self.loadfile_times = []
+        self._clients = []
+        self._observers = []
+        self._lock = threading.Lock()
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def close(self):
+        self._server.close()
+        for conn in self._clients:
+            conn.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def advance(self):
+        """Pasa a la siguiente entrada como si hubiera terminado la canción."""
+        with self._lock:
+            if self.pos + 1 < len(self.playlist):
+                self._set_pos(self.pos + 1)
+
+    def count(self):
+        with self._lock:
+            return len(self.playlist)
+
+    def _properties(self):
+        current = self.playlist[self.pos] if 0 <= self.pos < len(self.playlist) else None
+        return {
+            "pid": os.getpid(),
+            "playlist-pos": self.pos,
+            "playlist-count": len(self.playlist),
+            "path": current,
+            "media-title": current,
+            "pause": False,
+        }
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            self._clients.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn.makefile("rb") as stream:
+            for line in stream:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                with self._lock:
+                    reply = self._handle(conn, message.get("command") or [])
+                reply["request_id"] = message.get("request_id", 0)
+                self._send(conn, reply)
+
+    def _handle(self, conn, command):
+        name = command[0] if command else None
+        if name == "get_property":
+            value = self._properties().get(command[1])
+            if value is None and command[1] not in self._properties():
+                return {"error": "property unavailable"}
+            return {"error": "success", "data": value}
+        if name == "observe_property":
+            self._observers.append((conn, command[1], command[2]))
+            self._send(conn, {"event": "property-change", "id": command[1], "name": command[2],
+                              "data": self._properties().get(command[2])})
+        elif name == "loadfile":
+            self.loadfile_times.append(time.perf_counter())
+            url = command[1]
+            mode = command[2] if len(command) > 2 else "replace"
+            if mode == "replace":
+                self.playlist = [url]
+                self._set_pos(0)
+            elif mode == "insert-at":
+                index = int(command[3])
+                self.playlist.insert(index, url)
+                if index <= self.pos:
+                    self.pos += 1
+            else:
+                self.playlist.append(url)
+                if mode == "append-play" and self.pos < 0:
+                    self._set_pos(len(self.playlist) - 1)
+        elif name == "playlist-next":
+            if self.pos + 1 < len(self.playlist):
+                self._set_pos(self.pos + 1)
+        elif name == "playlist-remove":
+            index = int(command[1])
+            if 0 <= index < len(self.playlist):
+                del self.playlist[index]
+                if index < self.pos:
+                    self.pos -= 1
+        elif name not in ("set_property", "cycle", "playlist-prev", "quit"):
+            return {"error": "invalid parameter"}
+        return {"error": "success", "data": None}
+
+    def _set_pos(self, pos):
+        self.pos = pos
+        for conn in {c for c, _, _ in self._observers}:
+            self._send(conn, {"event": "start-file", "playlist_entry_id": pos + 1})
+        for conn, observe_id, name in self._observers:
+            if name in ("playlist-pos", "path", "media-title"):
+                self._send(conn, {"event": "property-change", "id": observe_id, "name": name,
+                                  "data": self._properties().get(name)})
+
+    def _send(self, conn, message):
+        try:
+            conn.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        except OSError:
+            pass
+
+class FixtureYTMusic:
+    """Sustituto de YTMusic: respuestas de un fixture (grabado o sintético) con latencia fija."""
+
+    def __init__(self, latency=0.0, fixture=None):
+        self.latency = latency
+        self.fixture = fixture or {}
+
+    def _reply(self, endpoint, default):
+        time.sleep(self.latency)
+        return self.fixture.get(endpoint, default)
+
+    @staticmethod
+    def _tracks(prefix, count):
+        return [{"videoId": f"{prefix}{i:06d}"[:11].ljust(11, "x"), "title": f"Track {prefix}{i}",
+                 "artists": [{"name": f"Artist {i % 13}"}], "thumbnails": []} for i in range(count)]
+
+    def search(self, query, filter=None, limit=20):
+        return self._reply("search", self._tracks("s" if filter == "songs" else "v", 3))
+
+    def get_watch_playlist(self, videoId=None, limit=25, **kwargs):
+        return self._reply("get_watch_playlist", {"tracks": self._tracks("w" + (videoId or "")[:3], limit)})
+
+    def get_mood_categories(self):
+        return self._reply("get_mood_categories", {"Moods": [{"title": "Chill", "params": "chill"}]})
+
+    def get_mood_playlists(self, params):
+        return self._reply("get_mood_playlists", [{"playlistId": f"PL{params}{i}"} for i in range(6)])
+
+    def get_playlist(self, playlistId, limit=100):
+        return self._reply("get_playlist", {"tracks": self._tracks("p" + playlistId[-1:], limit)})
+
+def wait_until(condition, timeout=30.0, interval=0.001):
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise TimeoutError("el servidor falso no llegó al estado esperado")
+        time.sleep(interval)
+
+def voluntary_switches():
+    """Cambios de contexto voluntarios de todos los hilos del proceso (Linux)."""
+    total = 0
+    for task in os.listdir("/proc/self/task"):
+        try:
+            with open(f"/proc/self/task/{task}/status") as f:
+                for line in f:
+                    if line.startswith("voluntary_ctxt_switches"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+def summarize(samples_ms):
+    ordered = sorted(samples_ms)
+    return {
+        "median": round(statistics.median(ordered), 3),
+        "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 3),
+        "max": round(ordered[-1], 3),
+        "samples": len(ordered),
+    }
+
+def run(args):
+    # Socket y PID del MPV falso en un directorio propio que se borra al terminar
+    with tempfile.TemporaryDirectory(prefix="bench_radio_") as workdir:
+        return _run(args, workdir)
+
+def _run(args, workdir):
+    radio.SOCKET_PATH = os.path.join(workdir, "mpv.sock")
+    radio.OWNER_PID_PATH = radio.SOCKET_PATH + ".pid"
+
+    fixture = None
+    if args.fixture:
+        with open(args.fixture, encoding="utf-8") as f:
+            fixture = json.load(f)
+    yt = radio.CachedYTMusic(None)
+    yt._client = FixtureYTMusic(args.latency, fixture)
+
+    # La notificación real va al bus de sesión: aquí solo se anota cuándo se envió
+    notified = []
+    radio.NotificationWorker._send = lambda self, *a: notified.append(time.perf_counter())
+
+    mpv = FakeMpv(radio.SOCKET_PATH)
+    # Sin teclas multimedia: con evdev se abrirían los /dev/input reales y cada
+    # pulsación llegaría al MPV falso (y a idle_wakeups_per_s)
+    session = radio.RadioSession(yt, media_keys=False)
+    results = {"latency_s": args.latency}
+    try:
+        session.start()
+
+        # Tiempo hasta el primer loadfile: búsqueda + carga de la primera canción
+        start = time.perf_counter()
+        first = radio.search_first(yt, "benchmark")
+        session.play([first], radio_seed=first['videoId'])
+        wait_until(lambda: mpv.loadfile_times)
+        results["time_to_first_loadfile_ms"] = round((mpv.loadfile_times[0] - start) * 1000, 3)
+        wait_until(lambda: mpv.count() > 1)
+
+        # Rendimiento al encolar: la cola entera debe llegar a MPV
+        results["enqueue"] = {}
+        for size in args.sizes:
+            tracks = FixtureYTMusic._tracks(f"q{size}", size)
+            before = mpv.count()
+            start = time.perf_counter()
+            session.play(tracks, enqueue=True)
+            wait_until(lambda: mpv.count() >= before + size)
+            elapsed = time.perf_counter() - start
+            results["enqueue"][str(size)] = {"seconds": round(elapsed, 4), "tracks_per_s": round(size / elapsed)}
+
+        # Cambio de pista -> notificación
+        samples = []
+        for _ in range(args.changes):
+            count = len(notified)
+            start = time.perf_counter()
+            mpv.advance()
+            wait_until(lambda: len(notified) > count, timeout=5)
+            samples.append((notified[-1] - start) * 1000)
+            time.sleep(0.01)
+        results["track_change_to_notification_ms"] = summarize(samples)
+
+        # Despertares en reposo: radio sonando, sin eventos de MPV ni teclas
+        time.sleep(0.5)
+        switches = voluntary_switches()
+        time.sleep(args.idle)
+        results["idle_wakeups_per_s"] = round((voluntary_switches() - switches) / args.idle, 2)
+    finally:
+        session.close()
+        radio.release_player_ownership(session.pid_path)
+        mpv.close()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks de radio.py con MPV y YouTube Music simulados")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latencia inyectada en cada llamada a YouTube Music (s)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 500, 5000], help="Tamaños de cola para medir el encolado")
+    parser.add_argument("--changes", type=int, default=30, help="Cambios de pista para medir la latencia de notificación")
+    parser.add_argument("--idle", type=float, default=3.0, help="Segundos de reposo para contar despertares")
+    parser.add_argument("--fixture", help="JSON con respuestas grabadas por endpoint (search, get_watch_playlist, ...)")
+    parser.add_argument("--output", help="Fichero donde escribir el JSON (por defecto stdout)")
+    args = parser.parse_args()
+
+    # radio.py informa por stdout: apartarlo para que solo salga el JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -2,48 +2,325 @@
 import sys
 import os
 import time
+
+# Marca de tiempo del arranque para --profile-startup
+_STARTUP_T0 = time.perf_counter()
+
+# Auto-activación del entorno virtual (antes de cualquier import pesado:
+# tras execv todo se vuelve a importar)
+if sys.prefix == sys.base_prefix:
+    venv_python = os.path.join(os.path.dirname(os.path.abspath(__file__)), "venv", "bin", "python")
+    if os.path.exists(venv_python):
+        os.execv(venv_python, [venv_python] + sys.argv)
+
 import json
 import socket
 import subprocess
 import threading
+import itertools
+import collections
+import random
+import queue
 import shutil
+import signal
 import argparse
-from ytmusicapi import YTMusic
-import requests
-
-try:
-    import evdev
-    from evdev import InputDevice, categorize, ecodes
-    HAS_EVDEV = True
-except ImportError:
-    HAS_EVDEV = False
-
-try:
-    from pynput import keyboard
-    HAS_PYNPUT = True
-except ImportError:
-    HAS_PYNPUT = False
-
-# Auto-activación del entorno virtual
-if sys.prefix == sys.base_prefix:
-    venv_python = os.path.join(os.path.dirname(os.path.abspath(__file__)), "venv", "bin", "python")
-    if os.path.exists(venv_python):
-        os.execv(venv_python, [venv_python] + sys.argv)
+import selectors
+import struct
+import sqlite3
+import hashlib
+import re
+import unicodedata
+import zlib
+import importlib.util
+
+# ytmusicapi, requests, yt-dlp, evdev y pynput se importan solo en el camino que
+# los necesita: listar categorías desde la caché no debe pagar su carga
+HAS_EVDEV = importlib.util.find_spec("evdev") is not None
+HAS_PYNPUT = importlib.util.find_spec("pynput") is not None
+HAS_YTDLP = importlib.util.find_spec("yt_dlp") is not None
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+
+_startup_marks = []
+
+def startup_mark(label):
+    """Anota cuánto se tardó en llegar a este punto desde el arranque."""
+    _startup_marks.append((label, time.perf_counter() - _STARTUP_T0))
+
+def print_startup_profile():
+    previous = 0.0
+    for label, elapsed in _startup_marks:
+        print(f"[startup] {elapsed * 1000:8.1f} ms  (+{(elapsed - previous) * 1000:6.1f})  {label}", file=sys.stderr)
+        previous = elapsed
+
+class Metrics:
+    """Histogramas de duraciones (segundos) por nombre y etiquetas, para --metrics.
+
+    Se exportan en formato de texto de Prometheus (p. ej. para el textfile
+    collector de node_exporter) o en JSON.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        # (nombre, etiquetas) -> [cuentas por cubeta, suma, total]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, seconds, labels=()):
+        key = (name, labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += seconds
+            series[2] += 1
+
+    def _snapshot(self):
+        with self._lock:
+            return sorted((key, ([*counts], total, count)) for key, (counts, total, count) in self._series.items())
+
+    def to_prometheus(self):
+        lines = []
+        typed = set()
+        for (name, labels), (counts, total, count) in self._snapshot():
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS, counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    def to_json(self):
+        result = {}
+        for (name, labels), (counts, total, count) in self._snapshot():
+            cumulative = list(itertools.accumulate(counts))
+            result.setdefault(name, []).append({
+                "labels": dict(labels),
+                "count": count,
+                "sum": round(total, 6),
+                "buckets": {str(bound): n for bound, n in zip(self.BUCKETS, cumulative)},
+            })
+        return json.dumps(result, indent=2) + "\n"
+
+    def write(self, path):
+        """Vuelca las métricas a path (JSON si acaba en .json, si no texto de Prometheus)."""
+        data = self.to_json() if path.endswith(".json") else self.to_prometheus()
+        # Escribir aparte y renombrar: quien lea el fichero nunca lo ve a medias
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error escribiendo métricas en {path}: {e}", file=sys.stderr)
+
+class _Span:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, self.labels)
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+# Solo existe con --metrics; sin él span() devuelve siempre el mismo objeto vacío
+_metrics = None
+
+def span(name, **labels):
+    """Mide la duración del bloque 'with' en el histograma name (si --metrics está activo)."""
+    if _metrics is None:
+        return _NULL_SPAN
+    return _Span(_metrics, name, tuple(sorted(labels.items())))
+
+def enable_metrics(path):
+    """Activa las métricas y las vuelca en path al salir y con cada SIGUSR1."""
+    global _metrics
+    _metrics = Metrics()
+    import atexit
+    atexit.register(_metrics.write, path)
+    # El volcado va en otro hilo: si la señal llega dentro de observe(), el hilo
+    # principal tiene tomado el lock de Metrics y escribir aquí se bloquearía
+    signal.signal(signal.SIGUSR1, lambda signum, frame: threading.Thread(target=_metrics.write, args=(path,), daemon=True).start())
+    return _metrics
+
+startup_mark("imports")
 
 # Configuración
-SOCKET_PATH = "/tmp/mpv_radio_socket"
-TEMP_THUMB = "/tmp/yt_radio_thumb.jpg"
+# Sockets y PIDs en el directorio de ejecución del usuario: otro usuario no los pisa
+RUNTIME_DIR = os.environ.get("XDG_RUNTIME_DIR") or "/tmp"
+SOCKET_PATH = os.path.join(RUNTIME_DIR, "mpv_radio_socket")
+OWNER_PID_PATH = SOCKET_PATH + ".pid"
+# Socket de control del demonio (--daemon)
+DAEMON_SOCKET_PATH = os.path.join(RUNTIME_DIR, "yt_radio_daemon_socket")
+# Sesión (zona) por defecto: usa SOCKET_PATH; las demás, SOCKET_PATH.<nombre>
+DEFAULT_SESSION = "default"
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "yt_radio")
+# Miniaturas de las notificaciones: tamaño máximo en disco y canciones por adelantado
+THUMB_CACHE_DIR = os.path.join(CACHE_DIR, "thumbs")
+THUMB_CACHE_MAX_BYTES = 50 * 1024 * 1024
+THUMB_PREFETCH_AHEAD = 3
+# Notificaciones: id a reemplazar (una sola burbuja para la radio) y espera máxima del bus
+NOTIFY_REPLACES_ID = 991122
+DBUS_TIMEOUT = 5
+# Pool HTTP compartido: hosts distintos, conexiones por host y reintentos
+HTTP_POOL_HOSTS = 4
+HTTP_POOL_SIZE = 8
+HTTP_RETRIES = 2
+# Entradas por escritura al cargar colas largas en MPV
+ENQUEUE_BATCH_SIZE = 200
+# Streams de audio resueltos por adelantado con yt-dlp: pistas por delante, hilos,
+# margen antes de que caduque la URL firmada y vigencia si la URL no la indica
+STREAM_RESOLVE_AHEAD = 3
+STREAM_RESOLVE_WORKERS = 2
+STREAM_URL_MARGIN = 10 * 60
+STREAM_URL_DEFAULT_TTL = 3600
+# Audio descargado por adelantado (--prefetch-audio): pistas por delante y tamaño máximo
+AUDIO_CACHE_DIR = os.path.join(CACHE_DIR, "audio")
+AUDIO_PREFETCH_AHEAD = 3
+AUDIO_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# Restos de descargas a medias: al arrancar se borran los que no se tocan desde hace este tiempo
+AUDIO_PARTIAL_MAX_AGE = 10 * 60
+# Palabras clave extra del modo prompt (JSON editable por el usuario)
+PROMPT_KEYWORDS_PATH = os.path.join(os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"), "yt_radio", "keywords.json")
+# Índice vectorial del modo prompt: dimensiones del hashing de n-gramas, pistas
+# cacheadas que se indexan, similitud mínima para fiarse de una pista y de una
+# categoría (las categorías se miran primero) y cada cuánto se reconstruye
+PROMPT_INDEX_DIM = 2048
+PROMPT_INDEX_MAX_TRACKS = 20000
+PROMPT_MATCH_MIN_SCORE = 0.3
+PROMPT_CATEGORY_MIN_SCORE = 0.25
+PROMPT_INDEX_MAX_AGE = 3600
+# Historial de escucha: fichero, escrituras por lote, horas durante las que no se
+# repite una canción y reproducciones a partir de las que se manda al final de la cola
+HISTORY_PATH = os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"), "yt_radio", "history.sqlite3")
+HISTORY_FLUSH_INTERVAL = 5
+HISTORY_FLUSH_BATCH = 50
+HISTORY_SKIP_HOURS = 12
+HISTORY_DOWNRANK_PLAYS = 3
+# Recomendador local: fichero, distancia máxima en una playlist para contar dos
+# canciones como relacionadas, vecinos guardados por canción y mínimo de pistas
+# para no tener que pedir la radio a la API
+RECOMMENDER_PATH = os.path.join(os.path.dirname(HISTORY_PATH), "recommender.sqlite3")
+RECOMMENDER_WINDOW = 10
+RECOMMENDER_MAX_NEIGHBORS = 200
+RECOMMENDER_MIN_TRACKS = 25
+# Índice local de canciones (búsqueda sin red y --mode local-search) y resultados por consulta
+TRACK_INDEX_PATH = os.path.join(os.path.dirname(HISTORY_PATH), "tracks.sqlite3")
+LOCAL_SEARCH_LIMIT = 50
+# Llamadas a YouTube Music en paralelo y playlists que se mezclan al abrir un mood
+API_POOL_WORKERS = 6
+MOOD_RADIO_PLAYLISTS = 3
+# Radio infinita: umbral de relleno, entradas reproducidas que se conservan y
+# videoIds recordados para no repetir
+ENDLESS_REFILL_THRESHOLD = 10
+ENDLESS_HISTORY = 25
+ENDLESS_SEEN_LIMIT = 5000
+# Hotplug de teclados: directorio vigilado y máscaras/estructura de inotify(7)
+INPUT_DEVICES_DIR = "/dev/input"
+IN_ATTRIB = 0x004
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+INOTIFY_EVENT = struct.Struct("iIII")
+# Propiedades de MPV que empujan los cambios de pista al bucle de monitorización
+OBSERVED_PROPERTIES = ("playlist-pos", "media-title", "path")
+# Caché de la API de YouTube Music: vigencia por endpoint (segundos), margen
+# durante el que se sirve una respuesta caducada mientras se refresca, y tamaño máximo
+API_CACHE_TTL = {
+    "get_mood_categories": 7 * 24 * 3600,
+    "get_mood_playlists": 24 * 3600,
+    "get_playlist": 6 * 3600,
+    "get_watch_playlist": 6 * 3600,
+    "search": 3600,
+}
+API_CACHE_MAX_STALE = 30 * 24 * 3600
+API_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+def _inotify_watch(path):
+    """Descriptor inotify que avisa de altas, bajas y cambios de permisos en path.
+
+    Devuelve None si el sistema no lo soporta (se sigue sin hotplug).
+    """
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, path.encode(), IN_CREATE | IN_DELETE | IN_ATTRIB) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError, TypeError):
+        return None
+
+def _read_inotify_events(fd):
+    """Lee los eventos pendientes de un descriptor inotify como (máscara, nombre)."""
+    events = []
+    while True:
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return events
+        if not data:
+            return events
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, mask, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + name_len].rstrip(b"\0").decode(errors="replace")
+            offset += name_len
+            events.append((mask, name))
 
 class MediaKeysController:
     def __init__(self, player):
         self.player = player
         self.running = False
         self.thread = None
-        self.evdev_devices = []
+        self.evdev_devices = {}
+        self._selector = None
+        self._evdev = None
+        self._media_key_codes = {}
+        self._wake_r = self._wake_w = None
         
     def start(self):
         self.running = True
         if HAS_EVDEV:
+            # Tubería para despertar al selector cuando se pide parar
+            self._wake_r, self._wake_w = os.pipe()
             self.thread = threading.Thread(target=self._evdev_listener)
         elif HAS_PYNPUT:
             self.thread = threading.Thread(target=self._pynput_listener)
@@ -55,35 +332,27 @@ class MediaKeysController:
         
     def stop(self):
         self.running = False
-        if self.thread:
-            self.thread.join(timeout=1)
-        for dev in self.evdev_devices:
+        if self._wake_w is not None:
             try:
-                dev.ungrab()
-            except:
+                os.write(self._wake_w, b"x")
+            except OSError:
                 pass
+        if self.thread:
+            self.thread.join(timeout=1)
+        if self._wake_w is not None and not (self.thread and self.thread.is_alive()):
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
                 
     def _evdev_listener(self):
+        self._selector = selectors.DefaultSelector()
+        watch_fd = None
         try:
             import evdev
             from evdev import ecodes
-            devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
-            
-            for dev in devices:
-                caps = dev.capabilities()
-                if ecodes.EV_KEY in caps:
-                    try:
-                        # IMPORTANTE: No usamos grab() para no bloquear el dispositivo al resto del sistema
-                        # dev.grab() 
-                        self.evdev_devices.append(dev)
-                    except PermissionError:
-                        continue
-                        
-            if not self.evdev_devices:
-                print("No se pudo acceder a dispositivos de entrada. Requiere permisos (grupo input o root).")
-                return
-                
-            media_key_codes = {
+            self._evdev = evdev
+
+            self._media_key_codes = {
                 ecodes.KEY_PLAYPAUSE: "play_pause",
                 ecodes.KEY_PLAY: "play",
                 ecodes.KEY_PAUSE: "pause",
@@ -95,21 +364,92 @@ class MediaKeysController:
                 ecodes.KEY_MUTE: "mute",
                 ecodes.KEY_MEDIA: "play_pause",
             }
-            
+
+            self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+            watch_fd = _inotify_watch(INPUT_DEVICES_DIR)
+            if watch_fd is not None:
+                self._selector.register(watch_fd, selectors.EVENT_READ, INPUT_DEVICES_DIR)
+
+            for path in evdev.list_devices():
+                self._open_device(path)
+
+            if not self.evdev_devices:
+                if watch_fd is None:
+                    print("No se pudo acceder a dispositivos de entrada. Requiere permisos (grupo input o root).")
+                    return
+                print("Sin teclas multimedia accesibles por ahora; esperando a que se conecte alguna.")
+
+            # Bloquea hasta que llega un evento de teclado, un cambio en /dev/input o stop()
             while self.running:
-                for dev in self.evdev_devices:
+                for key, _ in self._selector.select():
+                    if key.data is None:
+                        return
+                    if key.data == INPUT_DEVICES_DIR:
+                        self._handle_hotplug(watch_fd)
+                        continue
+
+                    dev = key.data
                     try:
-                        event = dev.read_one()
-                        if event and event.type == ecodes.EV_KEY and event.value == 1:
-                            action = media_key_codes.get(event.code)
-                            if action:
-                                self._handle_media_key(action)
-                    except (BlockingIOError, OSError):
+                        for event in dev.read():
+                            if event.type == ecodes.EV_KEY and event.value == 1:
+                                action = self._media_key_codes.get(event.code)
+                                if action:
+                                    self._handle_media_key(action)
+                    except BlockingIOError:
                         continue
-                time.sleep(0.01)
+                    except OSError:
+                        # Dispositivo desconectado
+                        self._close_device(dev.path)
                 
         except Exception as e:
             print(f"Error en listener evdev: {e}")
+        finally:
+            for path in list(self.evdev_devices):
+                self._close_device(path)
+            self._selector.close()
+            if watch_fd is not None:
+                os.close(watch_fd)
+
+    def _open_device(self, path):
+        if path in self.evdev_devices:
+            return
+        try:
+            dev = self._evdev.InputDevice(path)
+            keys = dev.capabilities().get(self._evdev.ecodes.EV_KEY, [])
+        except OSError:
+            # Sin permisos todavía (udev los ajusta tras crear el nodo) o ya no existe
+            return
+        # Solo los dispositivos que anuncian alguna tecla multimedia
+        if not self._media_key_codes.keys() & set(keys):
+            dev.close()
+            return
+        # IMPORTANTE: No usamos grab() para no bloquear el dispositivo al resto del sistema
+        self.evdev_devices[path] = dev
+        self._selector.register(dev.fd, selectors.EVENT_READ, dev)
+
+    def _close_device(self, path):
+        dev = self.evdev_devices.pop(path, None)
+        if dev is None:
+            return
+        try:
+            self._selector.unregister(dev.fd)
+        except (KeyError, ValueError):
+            pass
+        try:
+            dev.close()
+        except OSError:
+            pass
+
+    def _handle_hotplug(self, watch_fd):
+        for mask, name in _read_inotify_events(watch_fd):
+            if not name.startswith("event"):
+                continue
+            path = os.path.join(INPUT_DEVICES_DIR, name)
+            if mask & IN_DELETE:
+                self._close_device(path)
+            else:
+                # Alta o cambio de permisos: reintentar abrirlo
+                self._open_device(path)
             
     def _pynput_listener(self):
         try:
@@ -182,218 +522,1865 @@ class MediaKeysController:
             self.player.send_command({"command": ["cycle", "mute"]})
             print("[Control: Mute]")
 
-class MpvPlayer:
+class MpvError(Exception):
+    """Error devuelto por MPV o fallo de la conexión IPC."""
+
+class _PendingReply:
+    __slots__ = ("done", "response")
+
     def __init__(self):
-        # Limpiar socket anterior si existe
-        if os.path.exists(SOCKET_PATH):
-            os.remove(SOCKET_PATH)
-            
-        # Iniciar MPV como proceso independiente
-        # --idle: no cerrar cuando acabe la playlist
-        # --no-video: solo audio (ahorra recursos)
-        # --input-ipc-server: para controlarlo
-        # --ytdl-format: asegurar audio
-        self.process = subprocess.Popen([
-            "mpv",
-            "--idle",
-            "--no-video",
-            f"--input-ipc-server={SOCKET_PATH}",
-            "--ytdl-format=bestaudio/best"
-        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-        # Esperar a que el socket esté listo
-        retries = 20
-        while not os.path.exists(SOCKET_PATH) and retries > 0:
-            time.sleep(0.1)
-            retries -= 1
-            
-        if not os.path.exists(SOCKET_PATH):
-            raise Exception("No se pudo iniciar MPV IPC socket")
-            
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.connect(SOCKET_PATH)
+        self.done = threading.Event()
+        self.response = None
+
+class MpvIpcClient:
+    """Cliente JSON IPC de MPV compartible entre hilos.
+
+    Un hilo lector acumula líneas parciales del socket, entrega cada respuesta
+    al llamador que espera su request_id y despacha los mensajes 'event' a los
+    manejadores registrados, sin mezclar unos con otros.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.connected = True
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._event_handlers = []
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def on_event(self, handler):
+        """Registra handler(msg) para los eventos de MPV (se llama desde el hilo lector).
+
+        Al perder la conexión se entrega un último evento {"event": "disconnected"}.
+        """
+        self._event_handlers.append(handler)
+
+    def command(self, *args, timeout=5.0):
+        """Ejecuta un comando y espera su respuesta; devuelve 'data' o lanza MpvError."""
+        if not self.connected:
+            raise MpvError("Conexión con MPV cerrada")
+        request_id = next(self._ids)
+        pending = _PendingReply()
+        with self._pending_lock:
+            self._pending[request_id] = pending
+        try:
+            with span("mpv_command_seconds", command=args[0]):
+                self._send({"command": list(args), "request_id": request_id})
+                if not pending.done.wait(timeout):
+                    raise MpvError(f"Sin respuesta de MPV a {args[0]}")
+        finally:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+
+        response = pending.response
+        if response is None:
+            raise MpvError("Conexión con MPV cerrada")
+        if response.get("error") != "success":
+            raise MpvError(f"{args[0]}: {response.get('error')}")
+        return response.get("data")
+
+    def command_async(self, *args):
+        """Envía un comando sin esperar respuesta; los errores solo se registran."""
+        self.command_batch([args])
+
+    def command_batch(self, commands):
+        """Envía varios comandos en una sola escritura, sin esperar respuestas.
+
+        MPV los procesa en orden; los errores solo se registran, como en command_async.
+        """
+        lines = []
+        with self._pending_lock:
+            for args in commands:
+                request_id = next(self._ids)
+                self._pending[request_id] = None
+                lines.append(json.dumps({"command": list(args), "request_id": request_id}))
+        if lines:
+            # Sin respuesta que esperar: se mide lo que cuesta entregarlos
+            with span("mpv_send_seconds", command=commands[0][0] if len(commands) == 1 else "batch"):
+                self._send_raw(("\n".join(lines) + "\n").encode("utf-8"))
+
+    def _send(self, message):
+        self._send_raw((json.dumps(message) + "\n").encode("utf-8"))
+
+    def _send_raw(self, data):
+        try:
+            with self._send_lock:
+                self.sock.sendall(data)
+        except OSError as e:
+            raise MpvError(f"Error enviando comando MPV: {e}")
+
+    def _read_loop(self):
+        buffer = b""
+        try:
+            while True:
+                chunk = self.sock.recv(65536)
+                if not chunk:
+                    break
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line:
+                        self._dispatch(line)
+        except OSError:
+            pass
+        finally:
+            self.connected = False
+            # Despertar a todos los que esperan una respuesta que ya no llegará
+            with self._pending_lock:
+                waiting = [p for p in self._pending.values() if p is not None]
+                self._pending.clear()
+            for pending in waiting:
+                pending.done.set()
+            # Evento sintético para que quien escuche eventos sepa que MPV ya no está
+            self._dispatch(b'{"event": "disconnected"}')
+
+    def _dispatch(self, line):
+        try:
+            msg = json.loads(line)
+        except json.JSONDecodeError:
+            return
+
+        if "event" in msg:
+            for handler in self._event_handlers:
+                try:
+                    handler(msg)
+                except Exception as e:
+                    print(f"Error en manejador de evento MPV: {e}")
+            return
+
+        request_id = msg.get("request_id")
+        with self._pending_lock:
+            if request_id not in self._pending:
+                return
+            pending = self._pending.get(request_id)
+            if pending is None:
+                # Comando asíncrono: nadie espera, solo informar si falló
+                del self._pending[request_id]
+        if pending is None:
+            if msg.get("error") != "success":
+                print(f"Error de MPV: {msg.get('error')}")
+            return
+        pending.response = msg
+        pending.done.set()
+
+    def close(self):
+        self.connected = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class MpvPlayer:
+    def __init__(self, socket_path=None, audio_device=None):
+        self.socket_path = socket_path or SOCKET_PATH
+        self.audio_device = audio_device
+        self.process = None
         self.current_video_id = None
-        
+
+        # Reutilizar un MPV que ya esté escuchando en el socket (lanzamientos posteriores)
+        with span("mpv_start_seconds"):
+            sock = self._start()
+        self.ipc = MpvIpcClient(sock)
+        self.pid = self.get_property("pid")
+        # Un MPV reutilizado puede estar sacando el audio por otra salida
+        if self.reused and audio_device:
+            self.ipc.command_async("set_property", "audio-device", audio_device)
+
+        # Las cargas largas se envían por lotes desde un único hilo, en orden.
+        # Cada lote lleva la generación de la TrackQueue que lo pidió; un "replace"
+        # pasa a la generación de la cola nueva y los lotes de otras ya no se
+        # envían, aunque el hilo los hubiera sacado de la cola o se pidieran después
+        self._load_batches = queue.Queue()
+        self.load_generation = 0
+        self._load_lock = threading.Lock()
+        self._loader = threading.Thread(target=self._load_worker, daemon=True)
+        self._loader.start()
+
+    def _start(self):
+        """Socket conectado a MPV, lanzándolo si no hay ninguno escuchando."""
+        sock = self._connect_existing()
+        self.reused = sock is not None
+
+        if not self.reused:
+            # Socket huérfano de una sesión anterior: nadie escucha, se puede borrar
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+            # Iniciar MPV como proceso independiente
+            # --idle: no cerrar cuando acabe la playlist
+            # --no-video: solo audio (ahorra recursos)
+            # --input-ipc-server: para controlarlo
+            # --ytdl-format: asegurar audio
+            # --audio-device: salida de esta sesión (zona), si se indicó
+            # start_new_session: MPV sobrevive al proceso que lo lanzó para poder reutilizarlo
+            command = [
+                "mpv",
+                "--idle",
+                "--no-video",
+                f"--input-ipc-server={self.socket_path}",
+                "--ytdl-format=bestaudio/best"
+            ]
+            if self.audio_device:
+                command.append(f"--audio-device={self.audio_device}")
+            self.process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+            # Esperar a que el socket esté listo
+            retries = 20
+            while sock is None and retries > 0:
+                time.sleep(0.1)
+                retries -= 1
+                sock = self._connect_existing()
+
+            if sock is None:
+                raise Exception("No se pudo iniciar MPV IPC socket")
+        return sock
+
+    def _connect_existing(self):
+        """Conecta al socket de un MPV vivo; devuelve None si no hay nadie escuchando."""
+        if not os.path.exists(self.socket_path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            return None
+        return sock
+
+    def is_alive(self):
+        if not self.ipc.connected:
+            return False
+        if self.process:
+            return self.process.poll() is None
+        if not self.pid:
+            return False
+        try:
+            os.kill(self.pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
     def send_command(self, command):
-        """Envía un comando JSON a MPV."""
+        """Envía un comando JSON a MPV sin esperar la respuesta."""
         try:
-            data = json.dumps(command) + "\n"
-            self.sock.sendall(data.encode('utf-8'))
-            # Leer respuesta (básico, para vaciar buffer)
-            self.sock.setblocking(False)
-            try:
-                self.sock.recv(4096)
-            except BlockingIOError:
-                pass
-            self.sock.setblocking(True)
-        except Exception as e:
-            print(f"Error enviando comando MPV: {e}")
+            self.ipc.command_async(*command["command"])
+        except MpvError as e:
+            print(e)
+
+    def command(self, *args, timeout=5.0):
+        """Envía un comando y espera su resultado (lanza MpvError si falla)."""
+        return self.ipc.command(*args, timeout=timeout)
+
+    def subscribe(self):
+        """Observa los cambios de pista; devuelve una cola con los eventos de MPV."""
+        events = queue.Queue()
+        self.ipc.on_event(events.put)
+        for observe_id, prop in enumerate(OBSERVED_PROPERTIES, 1):
+            self.ipc.command("observe_property", observe_id, prop)
+        return events
 
-    def add_to_playlist(self, url, title=None):
-        cmd = {"command": ["loadfile", url, "append"]}
+    def add_to_playlist(self, url, title=None, mode="append-play"):
+        cmd = {"command": ["loadfile", url, mode]}
         self.send_command(cmd)
 
+    def load_urls(self, urls, mode="append-play", generation=0):
+        """Carga una lista de URLs: la primera suena ya, el resto se añade en segundo plano.
+
+        generation es la de la TrackQueue que describe estas URLs. Con
+        mode="replace" la primera sustituye la cola de MPV y esa generación pasa
+        a ser la actual: los lotes de cualquier otra se descartan.
+        """
+        urls = list(urls)
+        if not urls:
+            return
+        if mode == "replace":
+            # Con el lock, ningún lote viejo puede salir entre el cambio de
+            # generación y el loadfile que sustituye la cola
+            with self._load_lock:
+                self.load_generation = generation
+                self._discard_pending_loads()
+                self.add_to_playlist(urls[0], mode=mode)
+            urls = urls[1:]
+        for i in range(0, len(urls), ENQUEUE_BATCH_SIZE):
+            self._load_batches.put((generation, urls[i:i + ENQUEUE_BATCH_SIZE]))
+
+    def _discard_pending_loads(self):
+        try:
+            while True:
+                self._load_batches.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _load_worker(self):
+        while True:
+            generation, batch = self._load_batches.get()
+            try:
+                with self._load_lock:
+                    if generation != self.load_generation:
+                        continue
+                    with span("queue_batch_seconds"):
+                        self.ipc.command_batch([("loadfile", url, "append-play") for url in batch])
+            except MpvError as e:
+                print(e)
+                if not self.ipc.connected:
+                    return
+
     def get_property(self, prop):
-        cmd = {"command": ["get_property", prop]}
         try:
-            self.sock.sendall((json.dumps(cmd) + "\n").encode())
-            data = self.sock.recv(4096).decode()
-            # La respuesta puede ser múltiples líneas JSON
-            for line in data.split('\n'):
-                if not line: continue
-                try:
-                    resp = json.loads(line)
-                    if resp.get('error') == 'success':
-                        return resp.get('data')
-                except json.JSONDecodeError:
-                    pass
-        except Exception as e:
-            print(f"Error en get_property({prop}): {e}")
+            return self.ipc.command("get_property", prop)
+        except MpvError as e:
+            if not self.ipc.connected:
+                print(f"Error en get_property({prop}): {e}")
         return None
-        
+
     def close(self):
+        """Cierra MPV (propio o reutilizado) y libera el socket."""
         try:
-            self.process.terminate()
-            self.process.wait(timeout=2)
+            self.send_command({"command": ["quit"]})
+            if self.process:
+                self.process.wait(timeout=2)
         except subprocess.TimeoutExpired:
             self.process.kill()
         except Exception as e:
             print(f"Error cerrando MPV: {e}")
-            
-        if os.path.exists(SOCKET_PATH):
+
+        self.ipc.close()
+
+        if os.path.exists(self.socket_path):
             try:
-                os.remove(SOCKET_PATH)
+                os.remove(self.socket_path)
             except OSError:
                 pass
 
-def analyze_music_prompt(prompt):
-    """Analiza un prompt de texto para extraer intención musical."""
-    prompt_lower = prompt.lower()
-    
-    # Mapeo de palabras clave a géneros y moods
-    mood_keywords = {
-        'chill': ['relajante', 'tranquilo', 'chill', 'calma', 'suave'],
-        'energize': ['energético', 'activo', 'motivador', 'enérgico', 'energía'],
-        'focus': ['concentración', 'estudiar', 'trabajar', 'focus', 'concentrar'],
-        'workout': ['ejercicio', 'gym', 'deporte', 'entrenar', 'correr'],
-        'party': ['fiesta', 'party', 'bailar', 'celebrar'],
-        'sad': ['triste', 'melancólico', 'sad', 'depresivo'],
-        'romance': ['romántico', 'amor', 'romance'],
-        'sleep': ['dormir', 'sueño', 'descansar']
-    }
-    
-    genre_keywords = {
-        'rock': ['rock', 'rock en español'],
-        'pop': ['pop', 'pop latino'],
-        'jazz': ['jazz'],
-        'hip-hop': ['hip-hop', 'rap', 'hip hop'],
-        'electronic': ['electrónica', 'edm', 'techno', 'house', 'electronic'],
-        'classical': ['clásica', 'classical', 'orquesta'],
-        'reggae': ['reggae', 'ska'],
-        'metal': ['metal', 'heavy']
-    }
-    
-    # Detectar mood
-    detected_mood = None
-    for mood, keywords in mood_keywords.items():
-        if any(keyword in prompt_lower for keyword in keywords):
-            detected_mood = mood
-            break
-    
-    # Detectar género
-    detected_genre = None
-    for genre, keywords in genre_keywords.items():
-        if any(keyword in prompt_lower for keyword in keywords):
-            detected_genre = genre
-            break
-    
-    # Construir query de búsqueda
-    if detected_mood and detected_genre:
-        return f"{detected_mood} {detected_genre}"
-    elif detected_mood:
-        return detected_mood
-    elif detected_genre:
-        return detected_genre
-    else:
-        # Si no se detectó nada, usar el prompt original
-        return prompt
+    def detach(self):
+        """Suelta la conexión dejando MPV sonando (otra instancia toma el control)."""
+        self.ipc.close()
 
-def show_mood_categories(yt):
-    """Muestra categorías de mood/género disponibles y permite selección."""
+def session_socket_path(name=DEFAULT_SESSION):
+    """Socket IPC del MPV de la sesión name (el PID de su monitor va en <socket>.pid)."""
+    if not re.fullmatch(r"[\w-]+", name or ""):
+        raise ValueError(f"Nombre de sesión no válido: {name!r}")
+    return SOCKET_PATH if name == DEFAULT_SESSION else f"{SOCKET_PATH}.{name}"
+
+# Ficheros de PID que este proceso ha reclamado (uno por sesión)
+_claimed_pid_paths = set()
+
+def _is_radio_process(pid):
+    """True si pid es otro radio.py (y no un proceso ajeno que heredó un PID viejo)."""
     try:
-        categories = yt.get_mood_categories()
-        
-        print("\n=== Categorías Disponibles ===")
-        all_options = []
-        
-        for section, items in categories.items():
-            print(f"\n{section}:")
-            for idx, item in enumerate(items):
-                all_options.append(item)
-                print(f"  {len(all_options)}. {item['title']}")
-        
-        print(f"\n  0. Cancelar y volver")
-        
-        while True:
-            try:
-                choice = input("\nSelecciona un número: ").strip()
-                if not choice:
-                    continue
-                    
-                choice_num = int(choice)
-                
-                if choice_num == 0:
-                    return None
-                    
-                if 1 <= choice_num <= len(all_options):
-                    selected = all_options[choice_num - 1]
-                    print(f"\nSeleccionado: {selected['title']}")
-                    return selected
-                else:
-                    print(f"Por favor, ingresa un número entre 0 y {len(all_options)}")
-            except ValueError:
-                print("Por favor, ingresa un número válido")
-            except KeyboardInterrupt:
-                return None
-                
-    except Exception as e:
-        print(f"Error obteniendo categorías: {e}")
-        return None
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            argv = f.read().split(b"\0")
+    except OSError:
+        return False
+    return any(os.path.basename(arg) == b"radio.py" for arg in argv[:3])
 
-def get_radio_from_mood(yt, mood_params):
-    """Obtiene una playlist de radio basada en parámetros de mood."""
+def claim_player_ownership(pid_path=None, reused=True):
+    """Registra este proceso como monitor del MPV compartido y releva al anterior.
+
+    Solo un proceso monitoriza cada MPV (notificaciones, teclas multimedia). Si
+    otro lanzamiento sigue vivo, recibe SIGTERM y sale sin cerrar MPV. Con un
+    MPV recién arrancado (reused=False) el fichero de PID es de una ejecución
+    anterior y no se avisa a nadie.
+    """
+    pid_path = pid_path or OWNER_PID_PATH
+    previous = 0
+    if reused:
+        try:
+            with open(pid_path) as f:
+                previous = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            pass
+    if previous and not _is_radio_process(previous):
+        previous = 0
+
+    # Al demonio no se le quita un MPV: las peticiones se le mandan a él
+    if previous and previous != os.getpid() and previous == daemon_pid():
+        raise PlayerInUse("El reproductor de esta sesión lo controla el demonio de radio")
+
+    # Primero registrarnos: así el proceso anterior sabe que es un relevo y no un cierre
     try:
-        playlists = yt.get_mood_playlists(mood_params)
-        if playlists:
-            # Tomar la primera playlist
-            first_playlist = playlists[0]
-            playlist_id = first_playlist.get('playlistId')
-            
-            if playlist_id:
-                # Obtener contenido de la playlist
-                playlist = yt.get_playlist(playlist_id, limit=50)
-                return playlist.get('tracks', [])
-        return None
-    except Exception as e:
-        print(f"Error obteniendo radio por mood: {e}")
-        return None
+        with open(pid_path, "w") as f:
+            f.write(str(os.getpid()))
+        _claimed_pid_paths.add(pid_path)
+    except OSError as e:
+        print(f"Advertencia: no se pudo registrar el PID del monitor: {e}")
 
-def check_dependencies():
-    """Verifica que las herramientas del sistema estén instaladas."""
-    missing = []
-    if not shutil.which("mpv"):
-        missing.append("mpv")
-    if not shutil.which("notify-send"):
-        print("Advertencia: 'notify-send' no encontrado. Las notificaciones de escritorio no funcionarán.")
-    
-    if "mpv" in missing:
-        print("Error crítico: No se encontró 'mpv'.")
-        print("Por favor instálalo (ej: sudo apt install mpv).")
-        sys.exit(1)
+    if previous and previous != os.getpid():
+        try:
+            os.kill(previous, signal.SIGTERM)
+        except OSError:
+            pass
 
-def get_best_thumbnail(thumbnails):
-    """Obtiene el thumbnail de mejor calidad de la lista."""
-    if not thumbnails or not isinstance(thumbnails, list):
+def is_player_owner(pid_path=None):
+    try:
+        with open(pid_path or OWNER_PID_PATH) as f:
+            return int(f.read().strip() or 0) == os.getpid()
+    except (OSError, ValueError):
+        return True
+
+def release_player_ownership(pid_path=None):
+    pid_path = pid_path or OWNER_PID_PATH
+    _claimed_pid_paths.discard(pid_path)
+    if not is_player_owner(pid_path):
+        return
+    try:
+        os.remove(pid_path)
+    except OSError:
+        pass
+
+class PlayerTakenOver(Exception):
+    """Otra instancia de radio.py ha tomado el control del MPV compartido."""
+
+class PlayerInUse(Exception):
+    """El MPV que se quería usar lo controla el demonio (no se le releva)."""
+
+def daemon_pid():
+    """PID del demonio de radio si está vivo, o None."""
+    try:
+        with open(DAEMON_SOCKET_PATH + ".pid") as f:
+            pid = int(f.read().strip() or 0)
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return None
+    return pid or None
+
+def _on_sigterm(signum, frame):
+    if all(is_player_owner(path) for path in _claimed_pid_paths):
+        raise KeyboardInterrupt
+    raise PlayerTakenOver()
+
+def watch_url(video_id):
+    return f"https://www.youtube.com/watch?v={video_id}"
+
+class TrackQueue:
+    """Cola indexada de metadatos de las pistas cargadas en MPV.
+
+    Resuelve en tiempo constante la pista que suena a partir de la ruta que
+    reporta MPV ('path'), de su posición en la playlist o del videoId.
+    """
+
+    _generations = itertools.count(1)
+
+    def __init__(self, offset=0, generation=None):
+        # Posición en la playlist de MPV de nuestra primera entrada (>0 con --enqueue)
+        self.offset = offset
+        # Identifica la playlist de MPV que describe (ver MpvPlayer.load_urls);
+        # sin indicarla, una nueva que solo valdrá tras un "replace"
+        self.generation = next(self._generations) if generation is None else generation
+        self._entries = []
+        self._tracks = {}
+        self._paths = {}
+        # Apariciones de cada videoId en la cola, para podar sin perder duplicados
+        self._counts = {}
+        self._lock = threading.Lock()
+        # Una cola reemplazada por otra ya no debe recibir más canciones
+        self.retired = False
+        # videoId -> ruta que ya sustituye a su entrada de YouTube en MPV
+        # (stream resuelto o fichero local)
+        self._streamed = {}
+        # Serializa las ediciones de la playlist de MPV que dependen de posiciones
+        # (poda del feeder, sustitución por streams resueltos)
+        self.edit_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, track):
+        """Registra una pista y devuelve la URL a cargar en MPV (None si no es válida)."""
+        if not isinstance(track, dict):
+            return None
+
+        vid = track.get('videoId')
+        # Manejar None values
+        if not vid:
+            return None
+        if not isinstance(vid, str):
+            vid = str(vid)
+
+        title = track.get('title')
+        if not isinstance(title, str):
+            # A veces puede venir como objeto complejo o lista, aunque es raro en esta llamada
+            track = dict(track, title="Unknown" if title is None else str(title))
+
+        url = watch_url(vid)
+        with self._lock:
+            self._entries.append(vid)
+            self._tracks[vid] = track
+            self._paths[url] = vid
+            self._counts[vid] = self._counts.get(vid, 0) + 1
+        return url
+
+    def set_stream(self, video_id, url):
+        """Marca que la entrada de video_id en MPV ya es url (stream directo o fichero)."""
+        with self._lock:
+            self._streamed[video_id] = url
+            self._paths[url] = video_id
+
+    def has_stream(self, video_id):
+        return video_id in self._streamed
+
+    def stream_of(self, video_id):
+        return self._streamed.get(video_id)
+
+    def position_of(self, video_id, pos):
+        """Posición en MPV de la primera entrada de video_id posterior a pos (o None)."""
+        start = pos - self.offset + 1 if isinstance(pos, int) else 0
+        with self._lock:
+            for index in range(max(0, start), len(self._entries)):
+                if self._entries[index] == video_id:
+                    return self.offset + index
+        return None
+
+    def by_path(self, path):
+        return self._tracks.get(self._paths.get(path))
+
+    def by_position(self, pos):
+        if not isinstance(pos, int):
+            return None
+        index = pos - self.offset
+        with self._lock:
+            if 0 <= index < len(self._entries):
+                return self._tracks.get(self._entries[index])
+        return None
+
+    def upcoming(self, pos, count):
+        """Las count pistas que siguen a la posición pos."""
+        start = pos - self.offset + 1 if isinstance(pos, int) else 0
+        with self._lock:
+            return [self._tracks[vid] for vid in self._entries[max(0, start):max(0, start) + count]]
+
+    def last_video_id(self):
+        with self._lock:
+            return self._entries[-1] if self._entries else None
+
+    def remaining(self, pos):
+        """Entradas de esta cola que quedan por sonar después de la posición pos."""
+        if not isinstance(pos, int) or pos < self.offset:
+            return len(self._entries)
+        return max(0, len(self._entries) - (pos - self.offset) - 1)
+
+    def trim(self, count):
+        """Olvida las primeras count entradas (ya reproducidas y quitadas de MPV)."""
+        with self._lock:
+            removed, self._entries = self._entries[:count], self._entries[count:]
+            gone = set()
+            for vid in removed:
+                self._counts[vid] -= 1
+                if not self._counts[vid]:
+                    del self._counts[vid]
+                    self._tracks.pop(vid, None)
+                    gone.add(vid)
+            if gone:
+                self._paths = {path: vid for path, vid in self._paths.items() if vid not in gone}
+                for vid in gone:
+                    self._streamed.pop(vid, None)
+        return len(removed)
+
+    def resolve(self, path=None, pos=None):
+        """Pista que suena según MPV: primero por ruta, después por posición."""
+        return self.by_path(path) or self.by_position(pos)
+
+def describe_track(track, fallback_title):
+    """Devuelve (título, artista, videoId, thumbnail) para mostrar una pista."""
+    display_title = fallback_title
+    display_artist = "Radio"
+    video_id = None
+    thumb_url = None
+
+    if track:
+        display_title = track.get('title', fallback_title)
+        artists = track.get('artists', [])
+        if artists:
+            display_artist = artists[0]['name']
+
+        video_id = track.get('videoId')
+        if track.get('thumbnails'):
+            thumb_url = get_best_thumbnail(track['thumbnails'])
+
+    return display_title, display_artist, video_id, thumb_url
+
+class ApiCache:
+    """Caché SQLite de respuestas JSON con caducidad y expulsión LRU por tamaño."""
+
+    def __init__(self, path, max_bytes=API_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        # WAL: varios lanzamientos pueden leer mientras otro escribe
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS api_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+            " expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS api_cache_accessed ON api_cache (accessed)")
+        self._db.commit()
+
+    def get(self, key, max_stale=API_CACHE_MAX_STALE):
+        """Devuelve (valor, vigente) o None si no hay entrada utilizable."""
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._db.execute("SELECT value, expires FROM api_cache WHERE key = ?", (key,)).fetchone()
+                if row is None or row[1] + max_stale < now:
+                    return None
+                self._db.execute("UPDATE api_cache SET accessed = ? WHERE key = ?", (now, key))
+                self._db.commit()
+            return json.loads(row[0]), row[1] >= now
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Error leyendo caché: {e}", file=sys.stderr)
+            return None
+
+    def put(self, key, value, ttl):
+        data = json.dumps(value, default=str)
+        now = time.time()
+        try:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO api_cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, data, len(data), now + ttl, now),
+                )
+                self._evict()
+                self._db.commit()
+        except sqlite3.Error as e:
+            print(f"Error escribiendo caché: {e}", file=sys.stderr)
+
+    def values(self, endpoints):
+        """Respuestas guardadas de esos endpoints, de la más a la menos usada (caducadas incluidas)."""
+        clauses = " OR ".join("key LIKE ?" for _ in endpoints)
+        try:
+            with self._lock:
+                rows = self._db.execute(
+                    f"SELECT value FROM api_cache WHERE {clauses} ORDER BY accessed DESC",
+                    [endpoint + "%" for endpoint in endpoints],
+                ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error leyendo caché: {e}", file=sys.stderr)
+            return
+        for (value,) in rows:
+            try:
+                yield json.loads(value)
+            except ValueError:
+                continue
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM api_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Liberar hasta el 90% del límite empezando por lo menos usado
+        doomed = []
+        for key, size in self._db.execute("SELECT key, size FROM api_cache ORDER BY accessed"):
+            if total <= self.max_bytes * 0.9:
+                break
+            doomed.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM api_cache WHERE key = ?", doomed)
+
+class CachedYTMusic:
+    """YTMusic con caché en disco para las llamadas que usa la radio.
+
+    Una respuesta caducada (pero dentro de API_CACHE_MAX_STALE) se devuelve al
+    momento y se refresca en segundo plano; el cliente YTMusic real solo se
+    construye cuando hace falta ir a la red.
+    """
+
+    CACHED_METHODS = tuple(API_CACHE_TTL)
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self._client = None
+        self._client_lock = threading.Lock()
+        # Claves refrescándose; las protege _refresh_lock
+        self._refresh_lock = threading.Lock()
+        self._refreshing = set()
+        # Si es una lista, los refrescos se apuntan aquí en lugar de lanzar un
+        # hilo, para hacerlos luego en otro proceso (refresh_detached)
+        self.deferred_refreshes = None
+        # Funciones (endpoint, respuesta) avisadas con cada respuesta que llega de la red
+        self.observers = []
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                from ytmusicapi import YTMusic
+                startup_mark("import ytmusicapi")
+                self._client = YTMusic(requests_session=http_session())
+                startup_mark("YTMusic()")
+            return self._client
+
+    def __getattr__(self, name):
+        if name in self.CACHED_METHODS:
+            return lambda *args, **kwargs: self._cached_call(name, args, kwargs)
+        return getattr(self.client, name)
+
+    def _cached_call(self, endpoint, args, kwargs):
+        with span("ytmusic_call_seconds", endpoint=endpoint):
+            if self.cache is None:
+                with span("ytmusic_network_seconds", endpoint=endpoint):
+                    value = getattr(self.client, endpoint)(*args, **kwargs)
+                self._notify(endpoint, value)
+                return value
+
+            key = self._key(endpoint, args, kwargs)
+            hit = self.cache.get(key)
+            if hit is not None:
+                value, fresh = hit
+                if not fresh:
+                    self._refresh_async(key, endpoint, args, kwargs)
+                return value
+            return self._fetch(key, endpoint, args, kwargs)
+
+    @staticmethod
+    def _key(endpoint, args, kwargs):
+        return endpoint + json.dumps([args, kwargs], sort_keys=True, default=str)
+
+    def _notify(self, endpoint, value):
+        for observer in self.observers:
+            try:
+                observer(endpoint, value)
+            except Exception as e:
+                print(f"Error procesando respuesta de {endpoint}: {e}", file=sys.stderr)
+
+    def _fetch(self, key, endpoint, args, kwargs):
+        with span("ytmusic_network_seconds", endpoint=endpoint):
+            value = getattr(self.client, endpoint)(*args, **kwargs)
+        self._notify(endpoint, value)
+        # No cachear respuestas vacías: suelen ser fallos transitorios
+        if value:
+            self.cache.put(key, value, API_CACHE_TTL[endpoint])
+        return value
+
+    def _refresh_async(self, key, endpoint, args, kwargs):
+
+        def refresh():
+            try:
+                self._fetch(key, endpoint, args, kwargs)
+            except Exception as e:
+                print(f"Error refrescando caché ({endpoint}): {e}", file=sys.stderr)
+            finally:
+                with self._refresh_lock:
+                    self._refreshing.discard(key)
+
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            if self.deferred_refreshes is not None:
+                self.deferred_refreshes.append((key, endpoint, args, kwargs))
+                return
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def refresh_detached(self):
+        """Hace los refrescos aplazados en otro proceso, en su propia sesión, y vuelve al momento.
+
+        El $(...) del lanzador espera a que salga el proceso, no solo al EOF de
+        stdout: un hilo que siguiera refrescando retrasaría el menú. Es un proceso
+        nuevo y no un fork() porque SQLite no admite seguir usando la base de
+        datos heredada del padre.
+        """
+        calls, self.deferred_refreshes = self.deferred_refreshes, None
+        if not calls:
+            return
+        pending = json.dumps([[endpoint, args, kwargs] for _, endpoint, args, kwargs in calls], default=str)
+        try:
+            subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), "--refresh-cache", pending],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        except OSError as e:
+            print(f"Advertencia: no se pudo refrescar la caché ({e}).", file=sys.stderr)
+
+    def refresh_now(self, calls):
+        """Vuelve a pedir a la red cada (endpoint, args, kwargs) y lo guarda en la caché."""
+        for endpoint, args, kwargs in calls:
+            if endpoint not in self.CACHED_METHODS or self.cache is None:
+                continue
+            try:
+                self._fetch(self._key(endpoint, args, kwargs), endpoint, args, kwargs)
+            except Exception as e:
+                print(f"Error refrescando caché ({endpoint}): {e}", file=sys.stderr)
+
+def open_api_cache():
+    try:
+        return ApiCache(os.path.join(CACHE_DIR, "api_cache.sqlite3"))
+    except (OSError, sqlite3.Error) as e:
+        print(f"Advertencia: caché de la API no disponible ({e}).", file=sys.stderr)
+        return None
+
+class SQLiteStore:
+    """Base de los almacenes SQLite locales que escriben desde un hilo propio.
+
+    Las subclases crean sus tablas en _create() y encolan con _enqueue(); el
+    hilo escritor pasa lo encolado por _prepare() (sin locks) y _write() (con
+    la conexión tomada) y confirma. Quien encola (el bucle de monitorización,
+    los observadores de la API) nunca espera al disco.
+    """
+
+    # Respuestas de CachedYTMusic de las que observe() saca pistas para add_tracks()
+    OBSERVED_ENDPOINTS = ()
+    # Tabla que consulta is_empty()
+    TABLE = None
+    # Con FLUSH_INTERVAL se escribe cada tantos segundos o al juntar FLUSH_BATCH
+    # elementos; sin él, en cuanto llega algo
+    FLUSH_INTERVAL = None
+    FLUSH_BATCH = 1
+    WRITE_ERROR = "Error escribiendo en la base de datos"
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._create()
+        self._db.commit()
+        # _lock solo protege los buffers; _db_lock serializa la conexión. Orden: _db_lock -> _lock
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        # Lo aún no escrito (o escribiéndose)
+        self._unflushed = []
+        self._flushing = []
+        self._wake = threading.Event()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def is_empty(self):
+        with self._db_lock:
+            return self._db.execute(f"SELECT 1 FROM {self.TABLE} LIMIT 1").fetchone() is None
+
+    def observe(self, endpoint, value):
+        """Observador para CachedYTMusic: pasa a add_tracks() las pistas que llegan (no bloquea)."""
+        if endpoint not in self.OBSERVED_ENDPOINTS:
+            return
+        if isinstance(value, dict):
+            value = value.get('tracks')
+        if isinstance(value, list) and value:
+            self.add_tracks(value)
+
+    def close(self):
+        """Escribe lo pendiente y detiene el hilo escritor."""
+        self._closed = True
+        self._wake.set()
+        self._writer.join(timeout=5)
+
+    def _create(self):
+        raise NotImplementedError
+
+    def _enqueue(self, item):
+        with self._lock:
+            self._unflushed.append(item)
+            pending = len(self._unflushed)
+        # Despertar al escritor con lo primero que llega (para que empiece a
+        # contar el intervalo) y con el lote completo
+        if self.FLUSH_INTERVAL is None or pending == 1 or pending >= self.FLUSH_BATCH:
+            self._wake.set()
+
+    def _pending(self):
+        # Con _db_lock tomado: lo que aún no está en la base de datos
+        with self._lock:
+            return self._flushing + self._unflushed
+
+    def _write_loop(self):
+        while not self._closed:
+            # Sin nada pendiente el hilo duerme sin plazo: en reposo no hay despertares
+            self._wake.wait()
+            self._wake.clear()
+            with self._lock:
+                gather = self.FLUSH_INTERVAL and len(self._unflushed) < self.FLUSH_BATCH
+            if gather and not self._closed:
+                # Ya hay algo: juntar más hasta el intervalo o hasta llenar el lote
+                self._wake.wait(self.FLUSH_INTERVAL)
+                self._wake.clear()
+            self._flush()
+        self._flush()
+
+    def _flush(self):
+        with self._lock:
+            items, self._unflushed = self._unflushed, []
+            self._flushing = items
+        if not items:
+            return
+        data = self._prepare(items)
+        with self._db_lock:
+            try:
+                self._write(data)
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"{self.WRITE_ERROR}: {e}", file=sys.stderr)
+            with self._lock:
+                self._flushing = []
+
+    def _prepare(self, items):
+        return items
+
+    def _write(self, data):
+        raise NotImplementedError
+
+def feed_from_cache(yt, store, background=True):
+    """Engancha store a las respuestas de yt y, si está vacío, lo llena con las ya cacheadas.
+
+    El llenado inicial va en un hilo aparte salvo background=False.
+    """
+    yt.observers.append(store.observe)
+    if not yt.cache or not store.is_empty():
+        return
+
+    def bootstrap():
+        for endpoint in store.OBSERVED_ENDPOINTS:
+            for value in yt.cache.values((endpoint,)):
+                store.observe(endpoint, value)
+
+    if background:
+        threading.Thread(target=bootstrap, daemon=True).start()
+    else:
+        bootstrap()
+        store._flush()
+
+class ListeningHistory(SQLiteStore):
+    """Historial de escucha en SQLite: una fila por canción que empieza a sonar.
+
+    record() solo encola; el hilo escritor guarda por lotes cada
+    HISTORY_FLUSH_INTERVAL segundos (o al juntar HISTORY_FLUSH_BATCH).
+    """
+
+    TABLE = "plays"
+    FLUSH_INTERVAL = HISTORY_FLUSH_INTERVAL
+    FLUSH_BATCH = HISTORY_FLUSH_BATCH
+    WRITE_ERROR = "Error escribiendo historial"
+
+    def __init__(self, path=HISTORY_PATH):
+        super().__init__(path)
+
+    def _create(self):
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS plays ("
+            " id INTEGER PRIMARY KEY, video_id TEXT NOT NULL, played_at REAL NOT NULL,"
+            " title TEXT, artist TEXT)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS plays_video_id ON plays (video_id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS plays_played_at ON plays (played_at)")
+
+    def record(self, track):
+        """Apunta que track empieza a sonar (no bloquea)."""
+        title, artist, video_id, _ = describe_track(track, None)
+        if video_id:
+            self._enqueue((str(video_id), time.time(), title, artist))
+
+    def played_since(self, hours):
+        """videoIds que han sonado en las últimas hours horas."""
+        since = time.time() - hours * 3600
+        with self._db_lock:
+            recent = {vid for (vid,) in self._query("SELECT DISTINCT video_id FROM plays WHERE played_at >= ?", (since,))}
+            recent.update(row[0] for row in self._pending() if row[1] >= since)
+        return recent
+
+    def play_counts(self, video_ids):
+        """{videoId: veces que ha sonado} para los videoIds dados (0 si nunca)."""
+        video_ids = list(dict.fromkeys(video_ids))
+        counts = dict.fromkeys(video_ids, 0)
+        with self._db_lock:
+            # Por tandas: SQLite limita el número de parámetros por consulta
+            for i in range(0, len(video_ids), 500):
+                chunk = video_ids[i:i + 500]
+                marks = ",".join("?" * len(chunk))
+                for vid, count in self._query(f"SELECT video_id, COUNT(*) FROM plays WHERE video_id IN ({marks}) GROUP BY video_id", chunk):
+                    counts[vid] = count
+            for row in self._pending():
+                if row[0] in counts:
+                    counts[row[0]] += 1
+        return counts
+
+    def _query(self, sql, params):
+        try:
+            return self._db.execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            print(f"Error leyendo historial: {e}", file=sys.stderr)
+            return []
+
+    def _write(self, rows):
+        self._db.executemany("INSERT INTO plays (video_id, played_at, title, artist) VALUES (?, ?, ?, ?)", rows)
+
+def open_history():
+    try:
+        return ListeningHistory()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Advertencia: historial de escucha no disponible ({e}).", file=sys.stderr)
+        return None
+
+def rank_by_history(tracks, history):
+    """Quita de tracks lo escuchado hace poco y manda al final lo muy repetido.
+
+    Si todo se ha escuchado ya, se devuelve la lista entera reordenada en lugar
+    de dejar la radio vacía.
+    """
+    if not history or not tracks:
+        return tracks
+    recent = history.played_since(HISTORY_SKIP_HOURS)
+    vids = [t.get('videoId') for t in tracks if isinstance(t, dict)]
+    counts = history.play_counts([vid for vid in vids if vid])
+    fresh = [t for t in tracks if isinstance(t, dict) and t.get('videoId') not in recent]
+    # sorted es estable: dentro de cada grupo se conserva el orden de la radio
+    return sorted(fresh or tracks, key=lambda t: counts.get(t.get('videoId'), 0) >= HISTORY_DOWNRANK_PLAYS)
+
+
+class CooccurrenceRecommender(SQLiteStore):
+    """Radios sin API a partir de las playlists ya vistas.
+
+    Cada playlist o watch playlist que llega de YouTube Music suma 1 a cada par
+    de canciones que aparecen a menos de RECOMMENDER_WINDOW posiciones (matriz
+    dispersa en SQLite, clave (a, b)). La radio de una canción son sus vecinos
+    más frecuentes, completados con los vecinos de estos a mitad de peso.
+    """
+
+    OBSERVED_ENDPOINTS = ("get_playlist", "get_watch_playlist")
+    TABLE = "tracks"
+    WRITE_ERROR = "Error guardando recomendaciones"
+
+    def __init__(self, path=RECOMMENDER_PATH):
+        super().__init__(path)
+
+    def _create(self):
+        self._db.execute("CREATE TABLE IF NOT EXISTS tracks (video_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cooccurrence ("
+            " a TEXT NOT NULL, b TEXT NOT NULL, count INTEGER NOT NULL,"
+            " PRIMARY KEY (a, b)) WITHOUT ROWID"
+        )
+
+    def add_tracks(self, tracks):
+        """Suma los pares de una playlist recibida (los cuenta el hilo escritor)."""
+        tracks = [t for t in tracks if isinstance(t, dict) and isinstance(t.get('videoId'), str)]
+        if len(tracks) > 1:
+            self._enqueue(tracks)
+
+    def recommend(self, video_id, count=50, exclude=()):
+        """Hasta count pistas relacionadas con video_id, de más a menos afines."""
+        exclude = set(exclude)
+        exclude.add(video_id)
+        with self._db_lock:
+            neighbors = self._neighbors(video_id)
+            scores = collections.Counter()
+            for vid, weight in neighbors:
+                scores[vid] += weight
+            # Cobertura escasa: añadir los vecinos de los vecinos más cercanos
+            if len(neighbors) < count + len(exclude):
+                top = neighbors[0][1] if neighbors else 1
+                for vid, weight in neighbors[:10]:
+                    for second, second_weight in self._neighbors(vid):
+                        scores[second] += 0.5 * second_weight * weight / top
+            ranked = [vid for vid, _ in scores.most_common() if vid not in exclude][:count]
+            tracks = self._tracks(ranked)
+        return [tracks[vid] for vid in ranked if vid in tracks]
+
+    def _neighbors(self, video_id):
+        return self._db.execute(
+            "SELECT b, count FROM cooccurrence WHERE a = ? ORDER BY count DESC LIMIT ?",
+            (video_id, RECOMMENDER_MAX_NEIGHBORS),
+        ).fetchall()
+
+    def _tracks(self, video_ids):
+        found = {}
+        for i in range(0, len(video_ids), 500):
+            chunk = video_ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            for vid, data in self._db.execute(f"SELECT video_id, data FROM tracks WHERE video_id IN ({marks})", chunk):
+                found[vid] = json.loads(data)
+        return found
+
+    def _prepare(self, playlists):
+        pairs = collections.Counter()
+        tracks = {}
+        for playlist in playlists:
+            vids = [t['videoId'] for t in playlist]
+            for t in playlist:
+                tracks[t['videoId']] = t
+            for i, a in enumerate(vids):
+                for b in vids[i + 1:i + 1 + RECOMMENDER_WINDOW]:
+                    if a != b:
+                        pairs[a, b] += 1
+                        pairs[b, a] += 1
+        return pairs, tracks
+
+    def _write(self, data):
+        pairs, tracks = data
+        self._db.executemany(
+            "INSERT OR REPLACE INTO tracks (video_id, data) VALUES (?, ?)",
+            [(vid, json.dumps(t, default=str)) for vid, t in tracks.items()],
+        )
+        self._db.executemany(
+            "INSERT INTO cooccurrence (a, b, count) VALUES (?, ?, ?)"
+            " ON CONFLICT (a, b) DO UPDATE SET count = count + excluded.count",
+            [(a, b, n) for (a, b), n in pairs.items()],
+        )
+        self._prune({a for a, _ in pairs})
+
+    def _prune(self, video_ids):
+        # Cada canción conserva solo sus RECOMMENDER_MAX_NEIGHBORS vecinos más frecuentes
+        for vid in video_ids:
+            self._db.execute(
+                "DELETE FROM cooccurrence WHERE a = ? AND b NOT IN"
+                " (SELECT b FROM cooccurrence WHERE a = ? ORDER BY count DESC LIMIT ?)",
+                (vid, vid, RECOMMENDER_MAX_NEIGHBORS),
+            )
+
+
+def open_recommender(yt):
+    """Recomendador local enganchado a las respuestas de yt; None si no se puede abrir.
+
+    La primera vez se alimenta con las playlists que ya están en la caché de la API.
+    """
+    try:
+        recommender = CooccurrenceRecommender()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Advertencia: recomendador local no disponible ({e}).", file=sys.stderr)
+        return None
+    feed_from_cache(yt, recommender)
+    return recommender
+
+def radio_tracks(yt, video_id, recommender=None, exclude=(), limit=50):
+    """Radio de video_id: del recomendador local si conoce bastante, si no de la API."""
+    if recommender:
+        tracks = recommender.recommend(video_id, limit, exclude=exclude)
+        if len(tracks) >= RECOMMENDER_MIN_TRACKS:
+            return tracks
+    return yt.get_watch_playlist(videoId=video_id, limit=limit).get('tracks', [])
+
+class TrackIndex(SQLiteStore):
+    """Índice de texto completo (SQLite FTS5) de todas las canciones vistas.
+
+    Cada pista que llega de YouTube Music (radios, playlists y búsquedas) se
+    indexa por título, artistas y álbum, sin distinguir tildes y con índices de
+    prefijo para buscar mientras se escribe. Las pistas vistas más veces salen
+    antes a igualdad de relevancia.
+    """
+
+    OBSERVED_ENDPOINTS = ("get_playlist", "get_watch_playlist", "search")
+    TABLE = "tracks"
+    WRITE_ERROR = "Error indexando canciones"
+
+    def __init__(self, path=TRACK_INDEX_PATH):
+        super().__init__(path)
+
+    def _create(self):
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            " id INTEGER PRIMARY KEY, video_id TEXT NOT NULL UNIQUE, title TEXT NOT NULL,"
+            " artists TEXT NOT NULL, data TEXT NOT NULL, seen INTEGER NOT NULL, last_seen REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS tracks_popular ON tracks (seen DESC, last_seen DESC)")
+        # La rowid de cada fila del índice es el id de la pista en tracks
+        self._db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5("
+            " title, artists, album, tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3')"
+        )
+
+    def add_tracks(self, tracks):
+        # Las búsquedas sin filtro devuelven también artistas y playlists: solo pistas
+        tracks = [t for t in tracks if isinstance(t, dict) and isinstance(t.get('videoId'), str) and t.get('title')]
+        if tracks:
+            self._enqueue(tracks)
+
+    def search(self, text, limit=LOCAL_SEARCH_LIMIT):
+        """Pistas que contienen todas las palabras de text (como prefijos), de más a menos relevantes."""
+        words = re.findall(r"\w+", normalize_text(text))
+        if not words:
+            return []
+        # Cada palabra entre comillas: así no se interpretan AND, OR, NEAR...
+        query = " ".join(f'"{word}"*' for word in words)
+        with span("local_search_seconds"):
+            with self._db_lock:
+                rows = self._db.execute(
+                    "SELECT t.data FROM tracks_fts JOIN tracks t ON t.id = tracks_fts.rowid"
+                    " WHERE tracks_fts MATCH ?"
+                    " ORDER BY bm25(tracks_fts, 5.0, 10.0, 2.0) * (1.0 + MIN(t.seen, 20) / 20.0)"
+                    " LIMIT ?",
+                    (query, limit),
+                ).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def get(self, video_id):
+        with self._db_lock:
+            row = self._db.execute("SELECT data FROM tracks WHERE video_id = ?", (video_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def menu_lines(self):
+        """Líneas de menú de todas las pistas, de las más vistas a las menos.
+
+        Sale de las columnas de texto, sin decodificar el JSON de cada pista.
+        """
+        with self._db_lock:
+            rows = self._db.execute("SELECT title, artists, video_id FROM tracks ORDER BY seen DESC, last_seen DESC").fetchall()
+        return itertools.starmap(menu_line, rows)
+
+    @staticmethod
+    def _columns(track):
+        album = track.get('album')
+        if isinstance(album, dict):
+            album = album.get('name')
+        return str(track['title']), artist_names(track), album or ""
+
+    def _prepare(self, batches):
+        seen = collections.Counter()
+        tracks = {}
+        for batch in batches:
+            for t in batch:
+                seen[t['videoId']] += 1
+                tracks[t['videoId']] = t
+        return seen, tracks
+
+    def _write(self, data):
+        seen, tracks = data
+        now = time.time()
+        for vid, t in tracks.items():
+            row = self._db.execute("SELECT id FROM tracks WHERE video_id = ?", (vid,)).fetchone()
+            if row:
+                self._db.execute("UPDATE tracks SET seen = seen + ?, last_seen = ? WHERE id = ?", (seen[vid], now, row[0]))
+                continue
+            title, artists, album = self._columns(t)
+            cursor = self._db.execute(
+                "INSERT INTO tracks (video_id, title, artists, data, seen, last_seen) VALUES (?, ?, ?, ?, ?, ?)",
+                (vid, title, artists, json.dumps(t, default=str), seen[vid], now),
+            )
+            self._db.execute("INSERT INTO tracks_fts (rowid, title, artists, album) VALUES (?, ?, ?, ?)",
+                             (cursor.lastrowid, title, artists, album))
+
+def open_track_index(yt, background=True):
+    """Índice local de canciones enganchado a las respuestas de yt; None si no se puede abrir.
+
+    La primera vez se llena con las respuestas que ya están en la caché de la API
+    (en segundo plano, salvo background=False).
+    """
+    try:
+        index = TrackIndex()
+    except (OSError, sqlite3.Error) as e:
+        print(f"Advertencia: índice local de canciones no disponible ({e}).", file=sys.stderr)
+        return None
+    feed_from_cache(yt, index, background)
+    return index
+
+def artist_names(track):
+    return ", ".join(a['name'] for a in track.get('artists') or [] if isinstance(a, dict) and a.get('name'))
+
+def menu_line(title, artists, video_id):
+    """'Título - Artistas ;; videoId': una línea del menú de búsqueda local."""
+    return f"{' '.join(title.split())} - {artists or 'Desconocido'} ;; {video_id}"
+
+def track_line(track):
+    return menu_line(str(track.get('title', '')), artist_names(track), track['videoId'])
+
+def local_search(yt, index, query=None, limit=LOCAL_SEARCH_LIMIT):
+    """Líneas de menú para query: del índice local y, si no hay nada, de la API.
+
+    Sin query devuelve todo el índice de lo más visto a lo menos, para que el
+    menú (wofi) filtre mientras se escribe.
+    """
+    if not query:
+        return index.menu_lines() if index else iter(())
+    tracks = index.search(query, limit) if index else []
+    if not tracks:
+        tracks = [t for t in yt.search(query, filter="songs") or [] if t.get('videoId')]
+    return map(track_line, tracks[:limit])
+
+def local_lookup(index, query):
+    """Pista local para query: la línea de menú elegida o la mejor coincidencia del índice."""
+    if not index:
+        return None
+    match = re.search(r"^(.*?)\s*;;\s*([\w-]{11})\s*$", query)
+    if match:
+        # Línea de una respuesta de la API que aún no se había indexado
+        return index.get(match.group(2)) or {'videoId': match.group(2), 'title': match.group(1)}
+    results = index.search(query, 1)
+    return results[0] if results else None
+
+# Palabras clave de serie del modo prompt; se amplían con PROMPT_KEYWORDS_PATH
+MOOD_KEYWORDS = {
+    'chill': ['relajante', 'tranquilo', 'chill', 'calma', 'suave'],
+    'energize': ['energético', 'activo', 'motivador', 'enérgico', 'energía'],
+    'focus': ['concentración', 'estudiar', 'trabajar', 'focus', 'concentrar'],
+    'workout': ['ejercicio', 'gym', 'deporte', 'entrenar', 'correr'],
+    'party': ['fiesta', 'party', 'bailar', 'celebrar'],
+    'sad': ['triste', 'melancólico', 'sad', 'depresivo'],
+    'romance': ['romántico', 'amor', 'romance'],
+    'sleep': ['dormir', 'sueño', 'descansar']
+}
+
+GENRE_KEYWORDS = {
+    'rock': ['rock', 'rock en español'],
+    'pop': ['pop', 'pop latino'],
+    'jazz': ['jazz'],
+    'hip-hop': ['hip-hop', 'rap', 'hip hop'],
+    'electronic': ['electrónica', 'edm', 'techno', 'house', 'electronic'],
+    'classical': ['clásica', 'classical', 'orquesta'],
+    'reggae': ['reggae', 'ska'],
+    'metal': ['metal', 'heavy']
+}
+
+def normalize_text(text):
+    """Minúsculas, sin tildes y con los espacios colapsados ('Música  Clásica' -> 'musica clasica')."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return " ".join("".join(c for c in decomposed if not unicodedata.combining(c)).split())
+
+def _trie_pattern(words):
+    """Patrón regex equivalente a 'w1|w2|...' pero en forma de trie (prefijos compartidos).
+
+    El motor no prueba cada palabra por separado en cada posición: el coste
+    depende de la longitud del texto, no de cuántas palabras haya.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node):
+        alternatives = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ""
+        pattern = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+        # Si aquí ya termina una palabra, el resto es opcional (y codicioso: gana la más larga)
+        if "" in node:
+            pattern = f"(?:{pattern})?"
+        return pattern
+
+    return build(trie)
+
+class KeywordMatcher:
+    """Clasifica un prompt en moods y géneros con una sola pasada de regex.
+
+    Las palabras clave se normalizan (minúsculas, sin tildes) y se compilan en
+    un único patrón; cada coincidencia suma puntos a su mood o género, de modo
+    que gana el más mencionado y no el primero del diccionario.
+    """
+
+    def __init__(self, keywords):
+        # keywords: {"moods": {mood: [palabras]}, "genres": {género: [palabras]}}
+        self._labels = {}
+        for kind, groups in keywords.items():
+            for label, words in groups.items():
+                for word in words:
+                    key = normalize_text(word)
+                    if key and (kind, label) not in self._labels.get(key, ()):
+                        self._labels.setdefault(key, []).append((kind, label))
+        # Palabras enteras, admitiendo el plural: 'relajante' encuentra 'relajantes'
+        # pero 'rap' no encuentra 'rápido' ni 'pop' encuentra 'popular'
+        self._pattern = re.compile(r"(?<!\w)(" + _trie_pattern(self._labels) + r")(?:e?s)?(?!\w)") if self._labels else None
+
+    def scores(self, text):
+        """{tipo: {etiqueta: (puntos, primera posición)}} de todo lo que aparece en text."""
+        result = {}
+        if not self._pattern:
+            return result
+        for match in self._pattern.finditer(normalize_text(text)):
+            keyword = match.group(1)
+            # Las frases de varias palabras son más específicas que una sola
+            weight = keyword.count(" ") + 1
+            for kind, label in self._labels[keyword]:
+                points, first = result.setdefault(kind, {}).get(label, (0, match.start()))
+                result[kind][label] = (points + weight, first)
+        return result
+
+    def classify(self, text):
+        """(mood, género) con más puntos (a igualdad, el que aparece antes); None si no hay."""
+        scores = self.scores(text)
+
+        def best(kind):
+            candidates = scores.get(kind)
+            if not candidates:
+                return None
+            return max(candidates, key=lambda label: (candidates[label][0], -candidates[label][1]))
+
+        return best("moods"), best("genres")
+
+def load_prompt_keywords(path=PROMPT_KEYWORDS_PATH):
+    """Palabras clave de serie más las del fichero JSON del usuario, si existe.
+
+    Formato: {"moods": {"chill": ["lofi", ...]}, "genres": {"cumbia": ["cumbia", ...]}}
+    """
+    keywords = {
+        "moods": {mood: list(words) for mood, words in MOOD_KEYWORDS.items()},
+        "genres": {genre: list(words) for genre, words in GENRE_KEYWORDS.items()},
+    }
+    try:
+        with open(path, encoding="utf-8") as f:
+            extra = json.load(f)
+        for kind in ("moods", "genres"):
+            for label, words in (extra.get(kind) or {}).items():
+                keywords[kind].setdefault(label, []).extend(w for w in words if isinstance(w, str))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, AttributeError) as e:
+        print(f"Advertencia: no se pudo leer {path} ({e}).", file=sys.stderr)
+    return keywords
+
+_prompt_matcher = None
+_prompt_matcher_lock = threading.Lock()
+
+def prompt_matcher():
+    """KeywordMatcher del proceso, compilado una sola vez al primer prompt.
+
+    Con miles de términos de usuario compilar cuesta del orden de 100 ms: no se
+    paga al importar, para que listar categorías siga arrancando al momento.
+    """
+    global _prompt_matcher
+    with _prompt_matcher_lock:
+        if _prompt_matcher is None:
+            _prompt_matcher = KeywordMatcher(load_prompt_keywords())
+        return _prompt_matcher
+
+def analyze_music_prompt(prompt):
+    """Analiza un prompt de texto para extraer intención musical."""
+    detected_mood, detected_genre = prompt_matcher().classify(prompt)
+
+    # Construir query de búsqueda
+    if detected_mood and detected_genre:
+        return f"{detected_mood} {detected_genre}"
+    elif detected_mood:
+        return detected_mood
+    elif detected_genre:
+        return detected_genre
+    else:
+        # Si no se detectó nada, usar el prompt original
+        return prompt
+
+class PromptIndex:
+    """Índice vectorial local (NumPy, solo CPU) de categorías y pistas conocidas.
+
+    Cada texto se convierte en un vector de n-gramas de caracteres y palabras
+    repartidos por hashing en PROMPT_INDEX_DIM dimensiones; un prompt se compara
+    con todo el índice en una sola multiplicación matriz-vector (coseno). Sin
+    modelos ni red: tolera tildes, plurales y conjugaciones parecidas.
+    Categorías y pistas van en matrices separadas: las pistas solo se indexan
+    si se pasan (tracks=None deja el índice en las categorías).
+    """
+
+    def __init__(self, categories, tracks=None):
+        import numpy
+        self._np = numpy
+        self.categories = []
+        docs = []
+        matcher = prompt_matcher()
+        keywords = {**{("moods", k): v for k, v in MOOD_KEYWORDS.items()},
+                    **{("genres", k): v for k, v in GENRE_KEYWORDS.items()}}
+        for section, items in categories.items():
+            for item in items:
+                if not isinstance(item, dict) or not item.get('params'):
+                    continue
+                # Las palabras clave del mood/género que nombra la categoría acercan
+                # 'relajante' a 'Chill' aunque no compartan letras; también cuando
+                # el título es el propio nombre del mood ('Sleep' -> 'dormir')
+                words = set(normalize_text(item['title']).split())
+                labels = {(kind, label) for kind, found in matcher.scores(item['title']).items() for label in found}
+                labels |= {key for key in keywords if key[1] in words}
+                related = [word for key in sorted(labels) for word in keywords[key]]
+                self.categories.append(dict(item, section=section))
+                # Título y palabras clave pesan parecido: el prompt suele describir, no nombrar
+                docs.append(" ".join([item['title'], section] + related))
+        self._category_matrix = self._embed(docs)
+        self._category_words = [self._word_forms(doc) for doc in docs]
+
+        self.tracks = []
+        docs = []
+        seen = set()
+        for track in tracks or ():
+            vid = track.get('videoId') if isinstance(track, dict) else None
+            if not vid or vid in seen or not isinstance(track.get('title'), str):
+                continue
+            seen.add(vid)
+            artists = " ".join(a.get('name', '') for a in track.get('artists') or [] if isinstance(a, dict))
+            self.tracks.append(track)
+            docs.append(f"{track['title']} {artists}")
+        self.has_tracks = tracks is not None
+        self._track_matrix = self._embed(docs)
+        self.built = time.monotonic()
+
+    # Palabras de relleno habituales en los prompts: no dicen nada del estilo
+    STOPWORDS = frozenset(
+        "a al algo algunas algunos con de del el en for i la las los me mi music musica "
+        "of para por pon poner que quiero some something song songs cancion canciones "
+        "tema temas the to un una unas unos y".split()
+    )
+
+    @classmethod
+    def _word_forms(cls, text):
+        """Palabras con significado de text, también sin plural ('tristes' -> 'triste')."""
+        forms = set()
+        for word in normalize_text(text).split():
+            if word in cls.STOPWORDS:
+                continue
+            forms.add(word)
+            for suffix in ("s", "es"):
+                if word.endswith(suffix) and len(word) > len(suffix) + 2:
+                    forms.add(word[:-len(suffix)])
+        return forms
+
+    @classmethod
+    def _features(cls, text):
+        for word in normalize_text(text).split():
+            if word in cls.STOPWORDS:
+                continue
+            yield "w:" + word
+            padded = f" {word} "
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3]
+
+    def _embed(self, texts):
+        np = self._np
+        rows, cols, weights = [], [], []
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                rows.append(row)
+                cols.append(zlib.crc32(feature.encode("utf-8")) % PROMPT_INDEX_DIM)
+                # La palabra entera pesa más que sus trigramas
+                weights.append(2.0 if feature.startswith("w:") else 1.0)
+        matrix = np.zeros((len(texts), PROMPT_INDEX_DIM), dtype=np.float32)
+        np.add.at(matrix, (np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)), np.array(weights, dtype=np.float32))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.maximum(norms, 1e-9)
+
+    def search(self, prompt, count=5, kind="category"):
+        """Las count categorías (o pistas, kind="track") más parecidas al prompt: [(similitud, elemento)]."""
+        items = self.categories if kind == "category" else self.tracks
+        return [(score, items[i]) for score, i in self._ranked(prompt, kind)[:count]]
+
+    def match(self, prompt):
+        """(tipo, elemento, similitud) de la mejor coincidencia, o None.
+
+        Manda la categoría si alguna llega a PROMPT_CATEGORY_MIN_SCORE y comparte
+        con el prompt al menos una palabra entera: los trigramas solos no bastan
+        ('metallica' se parece a 'metal', pero pide un artista, no el género).
+        Solo si no, se mira si el prompt nombra una pista ya vista.
+        """
+        words = self._word_forms(prompt)
+        for score, i in self._ranked(prompt, "category"):
+            if score < PROMPT_CATEGORY_MIN_SCORE:
+                break
+            if words & self._category_words[i]:
+                return "category", self.categories[i], score
+        found = self._ranked(prompt, "track")[:1]
+        if found and found[0][0] >= PROMPT_MATCH_MIN_SCORE:
+            return "track", self.tracks[found[0][1]], found[0][0]
+        return None
+
+    def _ranked(self, prompt, kind):
+        # [(similitud, índice)] de mayor a menor
+        matrix = self._category_matrix if kind == "category" else self._track_matrix
+        if not len(matrix):
+            return []
+        np = self._np
+        scores = matrix @ self._embed([prompt])[0]
+        return [(float(scores[i]), int(i)) for i in np.argsort(scores)[::-1]]
+
+_prompt_index = None
+_prompt_index_lock = threading.Lock()
+_prompt_index_rebuilding = False
+
+def _build_prompt_index(yt, with_tracks):
+    try:
+        categories = yt.get_mood_categories() or {}
+    except Exception as e:
+        print(f"Error obteniendo categorías: {e}")
+        categories = {}
+    tracks = None
+    if with_tracks:
+        tracks = []
+        if yt.cache:
+            for value in yt.cache.values(("get_playlist", "get_watch_playlist")):
+                if isinstance(value, dict):
+                    tracks.extend(value.get('tracks') or [])
+                if len(tracks) >= PROMPT_INDEX_MAX_TRACKS:
+                    break
+        tracks = tracks[:PROMPT_INDEX_MAX_TRACKS]
+    return PromptIndex(categories, tracks)
+
+def prompt_index(yt, with_tracks=False):
+    """PromptIndex de las categorías (y con with_tracks, de las pistas de la caché); None sin NumPy.
+
+    Indexar miles de pistas cuesta alrededor de un segundo: solo lo hace el
+    demonio, que además lo rehace en segundo plano cada PROMPT_INDEX_MAX_AGE
+    mientras sigue respondiendo con el índice anterior. Un lanzamiento suelto
+    indexa solo las categorías.
+    """
+    global _prompt_index, _prompt_index_rebuilding
+    if not HAS_NUMPY:
+        return None
+    with _prompt_index_lock:
+        current = _prompt_index
+        if current is not None and current.has_tracks >= with_tracks:
+            if time.monotonic() - current.built <= PROMPT_INDEX_MAX_AGE or _prompt_index_rebuilding:
+                return current
+            _prompt_index_rebuilding = True
+
+            def rebuild():
+                global _prompt_index, _prompt_index_rebuilding
+                try:
+                    _prompt_index = _build_prompt_index(yt, current.has_tracks)
+                except Exception as e:
+                    print(f"Error reconstruyendo el índice de prompts: {e}", file=sys.stderr)
+                finally:
+                    _prompt_index_rebuilding = False
+            threading.Thread(target=rebuild, daemon=True).start()
+            return current
+        _prompt_index = _build_prompt_index(yt, with_tracks)
+        return _prompt_index
+
+def prompt_radio(yt, prompt, with_tracks=False):
+    """Interpreta un prompt y devuelve (tracks, seed_track, mood_params) para la radio.
+
+    Primero se consulta el índice local: si el prompt se parece lo bastante a
+    una categoría se carga su radio directamente, y si no, pero se parece a una
+    pista ya vista (with_tracks), se usa como semilla. Si no, se busca en
+    YouTube Music como siempre.
+    """
+    index = prompt_index(yt, with_tracks)
+    found = index.match(prompt) if index else None
+    if found:
+        kind, item, score = found
+        if kind == "category":
+            print(f"Interpretado como categoría: {item['title']} ({score:.2f})")
+            tracks = get_radio_from_mood(yt, item['params'])
+            if tracks:
+                return tracks, None, item['params']
+        else:
+            print(f"Interpretado como: {item['title']} ({score:.2f})")
+            return [], item, None
+
+    analyzed = analyze_music_prompt(prompt)
+    print(f"Interpretado: {analyzed}")
+    return [], search_first(yt, analyzed), None
+
+def show_mood_categories(yt):
+    """Muestra categorías de mood/género disponibles y permite selección."""
+    try:
+        categories = yt.get_mood_categories()
+        
+        print("\n=== Categorías Disponibles ===")
+        all_options = []
+        
+        for section, items in categories.items():
+            print(f"\n{section}:")
+            for idx, item in enumerate(items):
+                all_options.append(item)
+                print(f"  {len(all_options)}. {item['title']}")
+        
+        print(f"\n  0. Cancelar y volver")
+        
+        while True:
+            try:
+                choice = input("\nSelecciona un número: ").strip()
+                if not choice:
+                    continue
+                    
+                choice_num = int(choice)
+                
+                if choice_num == 0:
+                    return None
+                    
+                if 1 <= choice_num <= len(all_options):
+                    selected = all_options[choice_num - 1]
+                    print(f"\nSeleccionado: {selected['title']}")
+                    return selected
+                else:
+                    print(f"Por favor, ingresa un número entre 0 y {len(all_options)}")
+            except ValueError:
+                print("Por favor, ingresa un número válido")
+            except KeyboardInterrupt:
+                return None
+                
+    except Exception as e:
+        print(f"Error obteniendo categorías: {e}")
+        return None
+
+_api_pool = None
+_api_pool_lock = threading.Lock()
+
+def api_pool():
+    """Pool compartido para lanzar en paralelo llamadas independientes a YouTube Music."""
+    global _api_pool
+    with _api_pool_lock:
+        if _api_pool is None:
+            import concurrent.futures
+            _api_pool = concurrent.futures.ThreadPoolExecutor(max_workers=API_POOL_WORKERS, thread_name_prefix="api")
+        return _api_pool
+
+def interleave(track_lists):
+    """Mezcla varias listas de pistas alternándolas, sin repetir videoId."""
+    seen = set()
+    mixed = []
+    for group in itertools.zip_longest(*track_lists):
+        for track in group:
+            if isinstance(track, dict) and track.get('videoId') and track['videoId'] not in seen:
+                seen.add(track['videoId'])
+                mixed.append(track)
+    return mixed
+
+def get_radio_from_mood(yt, mood_params):
+    """Obtiene una radio basada en parámetros de mood.
+
+    Las primeras MOOD_RADIO_PLAYLISTS playlists del mood se piden a la vez y
+    se intercalan, así la espera es la de la más lenta y no la suma.
+    """
+    try:
+        playlists = yt.get_mood_playlists(mood_params)
+        playlist_ids = [p.get('playlistId') for p in (playlists or [])[:MOOD_RADIO_PLAYLISTS]]
+        futures = [api_pool().submit(yt.get_playlist, playlist_id, limit=50) for playlist_id in playlist_ids if playlist_id]
+        track_lists = []
+        for future in futures:
+            try:
+                track_lists.append(future.result().get('tracks', []))
+            except Exception as e:
+                print(f"Error obteniendo playlist del mood: {e}")
+        return interleave(track_lists) or None
+    except Exception as e:
+        print(f"Error obteniendo radio por mood: {e}")
+        return None
+
+def append_watch_playlist(yt, player, track_queue, video_id, history=None, recommender=None):
+    """Añade a la cola la radio de un videoId mientras ya suena la primera canción."""
+    try:
+        radio = radio_tracks(yt, video_id, recommender)
+    except Exception as e:
+        print(f"Error obteniendo radio: {e}")
+        return
+
+    # La watch playlist empieza por la propia semilla, que ya está sonando
+    tracks = [t for t in radio if isinstance(t, dict) and t.get('videoId') != video_id]
+    tracks = rank_by_history(tracks, history)
+    if track_queue.retired:
+        return
+    urls = [url for url in map(track_queue.add, tracks) if url]
+    # Si entretanto se reemplazó la cola, MPV descarta estos lotes por su generación
+    player.load_urls(urls, generation=track_queue.generation)
+    print(f"Radio: {len(urls)} canciones añadidas a la cola.")
+
+class RadioFeeder:
+    """Radio infinita: amplía la cola en segundo plano antes de que se agote.
+
+    Cuando quedan menos de ENDLESS_REFILL_THRESHOLD canciones pide la siguiente
+    página (otra playlist del mood o la radio de la última canción), descarta
+    los videoId ya escuchados y poda de MPV lo reproducido hace tiempo, de modo
+    que una sesión de horas mantiene la memoria acotada.
+    """
+
+    def __init__(self, yt, player, track_queue, seed_video_id=None, mood_params=None, history=None, recommender=None):
+        self.yt = yt
+        self.player = player
+        self.track_queue = track_queue
+        self.history = history
+        self.recommender = recommender
+        self.seed_video_id = seed_video_id
+        self.mood_params = mood_params
+        self._mood_playlists = None
+        # Las primeras playlists del mood ya se cargaron al empezar
+        self._next_playlist = MOOD_RADIO_PLAYLISTS
+        self._seen = collections.OrderedDict()
+        self._busy = threading.Lock()
+        self._pos = None
+        self._last_seed = None
+
+    def mark_seen(self, tracks):
+        for track in tracks:
+            if isinstance(track, dict) and track.get('videoId'):
+                self._seen[track['videoId']] = None
+                self._seen.move_to_end(track['videoId'])
+        while len(self._seen) > ENDLESS_SEEN_LIMIT:
+            self._seen.popitem(last=False)
+
+    def on_position(self, pos):
+        """Se llama con cada cambio de playlist-pos; no bloquea al bucle de monitorización."""
+        self._pos = pos
+        if not self._busy.acquire(blocking=False):
+            return
+        if self.track_queue.remaining(pos) < ENDLESS_REFILL_THRESHOLD:
+            threading.Thread(target=self._refill, daemon=True).start()
+            return
+        try:
+            self._trim()
+        finally:
+            self._busy.release()
+
+    def _refill(self):
+        try:
+            tracks = self._next_page()
+            if self.track_queue.retired:
+                return
+            fresh = [t for t in tracks if isinstance(t, dict) and t.get('videoId') and t['videoId'] not in self._seen]
+            fresh = rank_by_history(fresh, self.history)
+            self.mark_seen(fresh)
+            urls = [url for url in map(self.track_queue.add, fresh) if url]
+            if urls:
+                self.player.load_urls(urls, generation=self.track_queue.generation)
+                print(f"Radio infinita: {len(urls)} canciones nuevas en la cola.")
+            elif tracks:
+                # Página repetida: sembrar la próxima con otra canción para no atascarse
+                self.seed_video_id = random.choice(tracks).get('videoId') or self.seed_video_id
+            self._trim()
+        except Exception as e:
+            print(f"Error ampliando la radio: {e}")
+        finally:
+            self._busy.release()
+
+    def _next_page(self):
+        if self.mood_params:
+            if self._mood_playlists is None:
+                self._mood_playlists = self.yt.get_mood_playlists(self.mood_params) or []
+            while self._next_playlist < len(self._mood_playlists):
+                playlist_id = self._mood_playlists[self._next_playlist].get('playlistId')
+                self._next_playlist += 1
+                if playlist_id:
+                    return self.yt.get_playlist(playlist_id, limit=50).get('tracks', [])
+
+        # Sin más playlists del mood: continuar con la radio de la última canción,
+        # o con la semilla de repuesto si esa ya no aportó nada nuevo
+        last = self.track_queue.last_video_id()
+        seed = last if last and last != self._last_seed else self.seed_video_id
+        self._last_seed = seed
+        if not seed:
+            return []
+        # Lo ya escuchado no cuenta como cobertura del recomendador local
+        return radio_tracks(self.yt, seed, self.recommender, exclude=self._seen)
+
+    def _trim(self):
+        if not isinstance(self._pos, int):
+            return
+        played = self._pos - self.track_queue.offset
+        if played < 2 * ENDLESS_HISTORY:
+            return
+        excess = played - ENDLESS_HISTORY
+        with self.track_queue.edit_lock:
+            # Con la cola ya reemplazada, estas posiciones son de la playlist nueva
+            if self.track_queue.retired:
+                return
+            self.player.ipc.command_batch([("playlist-remove", self.track_queue.offset)] * excess)
+            self.track_queue.trim(excess)
+
+def check_dependencies():
+    """Verifica que las herramientas del sistema estén instaladas."""
+    missing = []
+    if not shutil.which("mpv"):
+        missing.append("mpv")
+    if not shutil.which("notify-send"):
+        print("Advertencia: 'notify-send' no encontrado. Las notificaciones de escritorio no funcionarán.")
+    
+    if "mpv" in missing:
+        print("Error crítico: No se encontró 'mpv'.")
+        print("Por favor instálalo (ej: sudo apt install mpv).")
+        sys.exit(1)
+
+def get_best_thumbnail(thumbnails):
+    """Obtiene el thumbnail de mejor calidad de la lista."""
+    if not thumbnails or not isinstance(thumbnails, list):
         return None
     
     # Buscar el thumbnail con mayor resolución
@@ -413,97 +2400,1406 @@ def get_best_thumbnail(thumbnails):
     
     return best_thumb
 
-def get_youtube_thumbnail(video_id):
-    """Obtiene thumbnail directo de YouTube (más confiable)."""
-    if not video_id:
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def http_session():
+    """Sesión HTTP compartida: conexiones keep-alive reutilizadas y reintentos con espera."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=0.3,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("HEAD", "GET", "POST"),
+            )
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            _http_session = session
+        return _http_session
+
+def get_youtube_thumbnail(video_id):
+    """Obtiene thumbnail directo de YouTube (más confiable)."""
+    if not video_id:
+        return None
+    
+    # YouTube thumbnails estándar
+    # maxresdefault: 1280x720, sddefault: 640x480, hqdefault: 480x360
+    formats = ['maxresdefault', 'sddefault', 'hqdefault', 'mqdefault', 'default']
+    
+    for fmt in formats:
+        url = f"https://img.youtube.com/vi/{video_id}/{fmt}.jpg"
+        try:
+            with span("http_request_seconds", kind="thumbnail_probe"):
+                response = http_session().head(url, timeout=3)
+            if response.status_code == 200:
+                return url
+        except:
+            continue
+    
+    return None
+
+class ThumbnailCache:
+    """Caché en disco de miniaturas, una por videoId, con límite de tamaño.
+
+    Cada pista tiene su propio fichero (nada de rutas compartidas entre hilos
+    de notificación) y prefetch() descarga en segundo plano las de las
+    próximas canciones para que la notificación salga sin esperar a la red.
+    """
+
+    def __init__(self, directory, max_bytes=THUMB_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def path_for(self, key):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.jpg")
+
+    def get(self, video_id, thumb_url=None):
+        """Ruta local de la miniatura, descargándola si aún no está en caché."""
+        key = video_id or thumb_url
+        if not key:
+            return None
+        path = self.path_for(key)
+        if os.path.exists(path):
+            # Marcar como usada recientemente para la expulsión LRU
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+            return path
+
+        # Si otro hilo ya la está descargando, esperar a ese en lugar de repetir
+        with self._lock:
+            done = self._in_flight.get(key)
+            owner = done is None
+            if owner:
+                done = self._in_flight[key] = threading.Event()
+        if not owner:
+            done.wait(10)
+            return path if os.path.exists(path) else None
+
+        try:
+            return self._download(path, video_id, thumb_url)
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            done.set()
+
+    def prefetch(self, tracks):
+        for track in tracks:
+            _, _, video_id, thumb_url = describe_track(track, None)
+            if (video_id or thumb_url) and not os.path.exists(self.path_for(video_id or thumb_url)):
+                if self._pool is None:
+                    import concurrent.futures
+                    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="thumbs")
+                self._pool.submit(self.get, video_id, thumb_url)
+
+    def _download(self, path, video_id, thumb_url):
+        # Prioridad: URL del thumbnail de YTMusic > Thumbnail directo de YouTube
+        url = thumb_url or get_youtube_thumbnail(video_id)
+        if not url:
+            return None
+        try:
+            with span("http_request_seconds", kind="thumbnail"):
+                response = http_session().get(url, timeout=5)
+            if response.status_code != 200:
+                return None
+            # Escribir aparte y renombrar: nunca se ve una imagen a medias
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(response.content)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Error descargando thumbnail: {e}")
+            return None
+        self._evict()
+        return path
+
+    def _evict(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.name.endswith(".jpg")]
+            stats = [(e.stat().st_mtime, e.stat().st_size, e.path) for e in entries]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in stats)
+        for _, size, path in sorted(stats):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+class StreamResolver:
+    """Resuelve con yt-dlp las URLs directas de audio de las próximas pistas.
+
+    MPV solo llama a yt-dlp cuando una entrada empieza a sonar, lo que deja
+    varios segundos de silencio en cada cambio. Aquí se resuelven antes, en un
+    pool pequeño, y se guardan hasta poco antes de que caduque la firma.
+    """
+
+    def __init__(self, workers=STREAM_RESOLVE_WORKERS):
+        self.workers = workers
+        # videoId -> (url, instante en que caduca)
+        self._urls = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = None
+        # YoutubeDL no es seguro entre hilos: una instancia por hilo del pool
+        self._local = threading.local()
+
+    def cached(self, video_id):
+        with self._lock:
+            entry = self._urls.get(video_id)
+        if entry and entry[1] - STREAM_URL_MARGIN > time.time():
+            return entry[0]
+        return None
+
+    def prefetch(self, video_ids, on_resolved):
+        """Resuelve en segundo plano; llama a on_resolved(video_id, url) con cada una."""
+        for video_id in video_ids:
+            url = self.cached(video_id)
+            if url:
+                on_resolved(video_id, url)
+                continue
+            with self._lock:
+                if video_id in self._pending:
+                    continue
+                self._pending.add(video_id)
+                if self._pool is None:
+                    import concurrent.futures
+                    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="streams")
+            self._pool.submit(self._resolve, video_id, on_resolved)
+
+    def _resolve(self, video_id, on_resolved):
+        try:
+            ydl = getattr(self._local, "ydl", None)
+            if ydl is None:
+                import yt_dlp
+                ydl = self._local.ydl = yt_dlp.YoutubeDL({
+                    "format": "bestaudio/best",
+                    "quiet": True,
+                    "no_warnings": True,
+                    "noplaylist": True,
+                })
+            info = ydl.extract_info(watch_url(video_id), download=False)
+            url = info.get("url")
+            if not url:
+                return
+            now = time.time()
+            with self._lock:
+                self._urls[video_id] = (url, self._expiry(url, now))
+                # Olvidar las que ya caducaron: la caché no crece con la sesión
+                for vid in [v for v, (_, expires) in self._urls.items() if expires <= now]:
+                    del self._urls[vid]
+            on_resolved(video_id, url)
+        except Exception as e:
+            print(f"No se pudo resolver el stream de {video_id}: {e}", file=sys.stderr)
+        finally:
+            with self._lock:
+                self._pending.discard(video_id)
+
+    @staticmethod
+    def _expiry(url, now):
+        # Las URLs de googlevideo llevan su caducidad en el parámetro 'expire'
+        from urllib.parse import urlsplit, parse_qs
+        try:
+            return int(parse_qs(urlsplit(url).query)["expire"][0])
+        except (KeyError, IndexError, ValueError):
+            return now + STREAM_URL_DEFAULT_TTL
+
+class AudioCache:
+    """Audio de las pistas descargado con yt-dlp, con límite de tamaño (LRU por bytes).
+
+    Con red inestable MPV se queda sin datos a mitad de canción; descargando la
+    actual y las siguientes se reproduce desde disco en cuanto están listas, y
+    repetir una categoría ya no toca la red.
+    """
+
+    def __init__(self, directory=AUDIO_CACHE_DIR, max_bytes=AUDIO_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._partial_dir = os.path.join(directory, ".partial")
+        os.makedirs(self._partial_dir, exist_ok=True)
+        self._clean_partial()
+        # videoId -> fichero (los videoId solo usan [A-Za-z0-9_-]: sirven de nombre)
+        self._files = {}
+        for entry in os.scandir(directory):
+            if entry.is_file():
+                self._files[entry.name.rsplit(".", 1)[0]] = entry.path
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def get(self, video_id):
+        """Fichero local de la pista o None si aún no está descargada."""
+        with self._lock:
+            path = self._files.get(video_id)
+        if not path:
+            return None
+        try:
+            # Marcar como usada recientemente para la expulsión LRU
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._files.pop(video_id, None)
+            return None
+        return path
+
+    def prefetch(self, video_ids, on_ready):
+        """Descarga en segundo plano; llama a on_ready(video_id, ruta) con cada una."""
+        for video_id in video_ids:
+            path = self.get(video_id)
+            if path:
+                on_ready(video_id, path)
+                continue
+            with self._lock:
+                if video_id in self._pending:
+                    continue
+                self._pending.add(video_id)
+                if self._pool is None:
+                    import concurrent.futures
+                    # Una descarga cada vez: no competir con la canción que suena
+                    self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="audio")
+            self._pool.submit(self._download, video_id, on_ready)
+
+    def _download(self, video_id, on_ready):
+        try:
+            import yt_dlp
+            options = {
+                "format": "bestaudio/best",
+                "outtmpl": {"default": os.path.join(self._partial_dir, "%(id)s.%(ext)s")},
+                "quiet": True,
+                "no_warnings": True,
+                "noprogress": True,
+                "noplaylist": True,
+            }
+            with yt_dlp.YoutubeDL(options) as ydl:
+                info = ydl.extract_info(watch_url(video_id), download=True)
+                downloads = info.get("requested_downloads") or [{}]
+                partial = downloads[0].get("filepath") or ydl.prepare_filename(info)
+            # Mover al directorio final solo cuando está completo
+            path = os.path.join(self.directory, os.path.basename(partial))
+            os.replace(partial, path)
+            with self._lock:
+                self._files[video_id] = path
+            self._evict()
+            on_ready(video_id, path)
+        except Exception as e:
+            print(f"No se pudo descargar el audio de {video_id}: {e}", file=sys.stderr)
+            self._clean_partial(video_id)
+        finally:
+            with self._lock:
+                self._pending.discard(video_id)
+
+    def _clean_partial(self, video_id=None):
+        """Borra de .partial los restos de video_id o, sin él, los abandonados.
+
+        Al arrancar no se tocan los modificados hace poco: pueden ser descargas
+        en curso de otro radio.py que comparte la caché.
+        """
+        cutoff = time.time() - AUDIO_PARTIAL_MAX_AGE
+        try:
+            entries = list(os.scandir(self._partial_dir))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if video_id is not None:
+                    if not entry.name.startswith(video_id + "."):
+                        continue
+                elif entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+    def _evict(self):
+        try:
+            entries = [e for e in os.scandir(self.directory) if e.is_file()]
+            stats = [(e.stat().st_mtime, e.stat().st_size, e.path, e.name) for e in entries]
+        except OSError:
+            return
+        total = sum(size for _, size, _, _ in stats)
+        for _, size, path, name in sorted(stats):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+            with self._lock:
+                self._files.pop(name.rsplit(".", 1)[0], None)
+
+def open_audio_cache():
+    if not HAS_YTDLP:
+        print("Advertencia: yt-dlp no está instalado como módulo; --prefetch-audio desactivado.")
+        return None
+    try:
+        return AudioCache()
+    except OSError as e:
+        print(f"Advertencia: caché de audio no disponible ({e}).")
         return None
-    
-    # YouTube thumbnails estándar
-    # maxresdefault: 1280x720, sddefault: 640x480, hqdefault: 480x360
-    formats = ['maxresdefault', 'sddefault', 'hqdefault', 'mqdefault', 'default']
-    
-    for fmt in formats:
-        url = f"https://img.youtube.com/vi/{video_id}/{fmt}.jpg"
-        try:
-            response = requests.head(url, timeout=3)
-            if response.status_code == 200:
-                return url
-        except:
-            continue
-    
-    return None
 
-def send_notification(title, artist, video_id, thumb_url=None):
-    
-    """Descarga thumb y notifica."""
+def open_stream_resolver():
+    return StreamResolver() if HAS_YTDLP else None
+
+def open_thumbnail_cache():
     try:
-        # Prioridad: URL del thumbnail de YTMusic > Thumbnail directo de YouTube > Fallback
-        final_thumb_url = None
-        
-        if thumb_url:
-            final_thumb_url = thumb_url
-        elif video_id:
-            final_thumb_url = get_youtube_thumbnail(video_id)
-        
-        # Descargar imagen
-        if final_thumb_url:
+        return ThumbnailCache(THUMB_CACHE_DIR)
+    except OSError as e:
+        print(f"Advertencia: caché de miniaturas no disponible ({e}).")
+        return None
+
+class DBusError(Exception):
+    pass
+
+# Tipos de tamaño fijo del protocolo D-Bus: formato struct y alineación
+_DBUS_FIXED = {"y": ("B", 1), "b": ("I", 4), "n": ("h", 2), "q": ("H", 2), "i": ("i", 4),
+               "u": ("I", 4), "x": ("q", 8), "t": ("Q", 8), "d": ("d", 8), "h": ("I", 4)}
+
+def _dbus_type_end(signature, i):
+    """Índice donde acaba el tipo completo que empieza en signature[i]."""
+    code = signature[i]
+    if code == "a":
+        return _dbus_type_end(signature, i + 1)
+    if code in "({":
+        close = ")" if code == "(" else "}"
+        i += 1
+        while signature[i] != close:
+            i = _dbus_type_end(signature, i)
+    return i + 1
+
+def _dbus_split(signature):
+    types, i = [], 0
+    while i < len(signature):
+        end = _dbus_type_end(signature, i)
+        types.append(signature[i:end])
+        i = end
+    return types
+
+def _dbus_alignment(code):
+    if code in _DBUS_FIXED:
+        return _DBUS_FIXED[code][1]
+    if code in "so" or code.startswith("a"):
+        return 4
+    return 8 if code[0] in "({" else 1
+
+def _dbus_pad(buf, alignment):
+    buf.extend(b"\0" * (-len(buf) % alignment))
+
+def _dbus_marshal(buf, code, value):
+    """Serializa value (tipo code) en little-endian al final de buf."""
+    kind = code[0]
+    if kind in _DBUS_FIXED:
+        fmt, size = _DBUS_FIXED[kind]
+        _dbus_pad(buf, size)
+        buf.extend(struct.pack("<" + fmt, value))
+    elif kind in "so":
+        data = value.encode("utf-8")
+        _dbus_pad(buf, 4)
+        buf.extend(struct.pack("<I", len(data)) + data + b"\0")
+    elif kind == "g":
+        data = value.encode("ascii")
+        buf.extend(bytes([len(data)]) + data + b"\0")
+    elif kind == "v":
+        signature, inner = value
+        _dbus_marshal(buf, "g", signature)
+        _dbus_marshal(buf, signature, inner)
+    elif kind == "a":
+        _dbus_pad(buf, 4)
+        length_at = len(buf)
+        buf.extend(b"\0\0\0\0")
+        element = code[1:]
+        # El relleno hasta el primer elemento no cuenta en la longitud del array
+        _dbus_pad(buf, _dbus_alignment(element))
+        start = len(buf)
+        for item in (value.items() if element.startswith("{") else value):
+            _dbus_marshal(buf, element, item)
+        struct.pack_into("<I", buf, length_at, len(buf) - start)
+    else:
+        _dbus_pad(buf, 8)
+        for member, item in zip(_dbus_split(code[1:-1]), value):
+            _dbus_marshal(buf, member, item)
+
+class _DBusReader:
+    """Deserializa un mensaje D-Bus recibido (en el orden de bytes que indique)."""
+
+    def __init__(self, data, order):
+        self.data = data
+        self.order = order
+        self.pos = 0
+
+    def align(self, alignment):
+        self.pos += -self.pos % alignment
+
+    def read(self, code):
+        kind = code[0]
+        if kind in _DBUS_FIXED:
+            fmt, size = _DBUS_FIXED[kind]
+            self.align(size)
+            value, = struct.unpack_from(self.order + fmt, self.data, self.pos)
+            self.pos += size
+            return value
+        if kind in "sog":
+            if kind == "g":
+                length = self.data[self.pos]
+                self.pos += 1
+            else:
+                length = self.read("u")
+            value = self.data[self.pos:self.pos + length].decode("utf-8", "replace")
+            self.pos += length + 1
+            return value
+        if kind == "v":
+            signature = self.read("g")
+            return (signature, self.read(signature))
+        if kind == "a":
+            length = self.read("u")
+            element = code[1:]
+            self.align(_dbus_alignment(element))
+            end = self.pos + length
+            items = []
+            while self.pos < end:
+                items.append(self.read(element))
+            return dict(items) if element.startswith("{") else items
+        self.align(8)
+        return tuple(self.read(member) for member in _dbus_split(code[1:-1]))
+
+class DBusConnection:
+    """Cliente mínimo del bus de sesión de D-Bus, solo con la biblioteca estándar.
+
+    Cubre lo que necesitan las notificaciones: socket Unix, autenticación
+    EXTERNAL, Hello y llamadas a métodos con su respuesta. Las señales que
+    lleguen entre medias se descartan.
+    """
+
+    METHOD_CALL, METHOD_RETURN, ERROR = 1, 2, 3
+
+    def __init__(self, address=None, timeout=DBUS_TIMEOUT):
+        self._serials = itertools.count(1)
+        self._buffer = b""
+        self.sock = self._connect(address or self.session_address(), timeout)
+        try:
+            self._authenticate()
+            self.unique_name = self.call("org.freedesktop.DBus", "/org/freedesktop/DBus",
+                                         "org.freedesktop.DBus", "Hello")[0]
+        except Exception:
+            self.close()
+            raise
+
+    @staticmethod
+    def session_address():
+        address = os.environ.get("DBUS_SESSION_BUS_ADDRESS")
+        if address:
+            return address
+        # Con systemd el bus de sesión suele estar en $XDG_RUNTIME_DIR/bus aunque no se exporte
+        runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+        if runtime_dir and os.path.exists(os.path.join(runtime_dir, "bus")):
+            return "unix:path=" + os.path.join(runtime_dir, "bus")
+        raise DBusError("no hay bus de sesión (DBUS_SESSION_BUS_ADDRESS sin definir)")
+
+    @staticmethod
+    def _connect(address, timeout):
+        from urllib.parse import unquote
+        error = None
+        for entry in address.split(";"):
+            transport, _, params = entry.partition(":")
+            options = dict(item.split("=", 1) for item in params.split(",") if "=" in item)
+            if transport != "unix":
+                continue
+            if "path" in options:
+                target = unquote(options["path"])
+            elif "abstract" in options:
+                target = "\0" + unquote(options["abstract"])
+            else:
+                continue
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
             try:
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-                }
-                response = requests.get(final_thumb_url, headers=headers, timeout=5)
-                if response.status_code == 200:
-                    with open(TEMP_THUMB, 'wb') as f:
-                        f.write(response.content)
-                    icon_arg = TEMP_THUMB
-                else:
-                    icon_arg = "audio-x-generic"
-            except Exception as e:
-                print(f"Error descargando thumbnail: {e}")
-                icon_arg = "audio-x-generic"
-        else:
-            icon_arg = "audio-x-generic"
-            
+                sock.connect(target)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error or DBusError(f"dirección de bus no soportada: {address}")
+
+    def _authenticate(self):
+        uid = str(os.getuid()).encode("ascii").hex().encode("ascii")
+        self.sock.sendall(b"\0AUTH EXTERNAL " + uid + b"\r\n")
+        reply = self._read_line()
+        if not reply.startswith(b"OK "):
+            raise DBusError(f"autenticación rechazada: {reply.decode('ascii', 'replace')}")
+        self.sock.sendall(b"BEGIN\r\n")
+
+    def _read_line(self):
+        while b"\r\n" not in self._buffer:
+            self._fill()
+        line, self._buffer = self._buffer.split(b"\r\n", 1)
+        return line
+
+    def _fill(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("el bus cerró la conexión")
+        self._buffer += chunk
+
+    def _read_exact(self, size):
+        while len(self._buffer) < size:
+            self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _read_message(self):
+        fixed = self._read_exact(16)
+        order = "<" if fixed[:1] == b"l" else ">"
+        body_length, serial, fields_length = struct.unpack(order + "III", fixed[4:16])
+        rest = self._read_exact(fields_length + (-(16 + fields_length) % 8) + body_length)
+        reader = _DBusReader(fixed + rest, order)
+        reader.pos = 12
+        fields = dict(reader.read("a(yv)"))
+        reader.align(8)
+        signature = fields.get(8, ("g", ""))[1]
+        body = [reader.read(code) for code in _dbus_split(signature)]
+        return fixed[1], serial, fields, body
+
+    def call(self, destination, path, interface, member, signature="", args=()):
+        serial = next(self._serials)
+        fields = [(1, ("o", path)), (2, ("s", interface)), (3, ("s", member)), (6, ("s", destination))]
+        if signature:
+            fields.append((8, ("g", signature)))
+        body = bytearray()
+        for code, value in zip(_dbus_split(signature), args):
+            _dbus_marshal(body, code, value)
+        message = bytearray()
+        _dbus_marshal(message, "(yyyyuua(yv))", (ord("l"), self.METHOD_CALL, 0, 1, len(body), serial, fields))
+        _dbus_pad(message, 8)
+        self.sock.sendall(bytes(message + body))
+
+        while True:
+            kind, _, reply_fields, reply = self._read_message()
+            if reply_fields.get(5, ("u", None))[1] != serial:
+                continue
+            if kind == self.ERROR:
+                name = reply_fields.get(4, ("s", "error"))[1]
+                raise DBusError(f"{name}: {reply[0] if reply else ''}")
+            return reply
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+def send_notification(title, artist, icon=None, replaces_id=NOTIFY_REPLACES_ID, summary="YouTube Radio"):
+    """Notificación con notify-send, para cuando no hay bus de sesión."""
+    try:
         subprocess.run([
             "notify-send",
-            "-r", "991122",
-            "-i", icon_arg,
-            "YouTube Radio",
+            "-r", str(replaces_id),
+            "-i", icon or "audio-x-generic",
+            summary,
             f"{title}\n{artist}"
         ], check=False)
     except Exception as e:
         print(f"Error notificación: {e}")
 
+class NotificationWorker:
+    """Un solo hilo para todas las notificaciones, con hueco único: gana la última.
+
+    Pedir una notificación solo deja la pista en el hueco y despierta al hilo;
+    si se saltan varias canciones mientras se baja una miniatura, solo se
+    notifica la última. El envío va por una conexión D-Bus persistente a
+    org.freedesktop.Notifications (sin arrancar notify-send en cada pista) y
+    reemplaza siempre la misma burbuja.
+    """
+
+    def __init__(self, thumbnails=None, bus_address=None, replaces_id=NOTIFY_REPLACES_ID, summary="YouTube Radio"):
+        self.thumbnails = thumbnails
+        self.bus_address = bus_address
+        self.summary = summary
+        self._bus = None
+        self._replaces_id = replaces_id
+        self._pending = None
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def notify(self, title, artist, video_id=None, thumb_url=None):
+        with self._cond:
+            self._pending = (title, artist, video_id, thumb_url)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=DBUS_TIMEOUT)
+        if self._bus:
+            self._bus.close()
+            self._bus = None
+
+    def _take(self):
+        with self._cond:
+            while self._pending is None and not self._closed:
+                self._cond.wait()
+            item, self._pending = self._pending, None
+            return item
+
+    def _run(self):
+        while True:
+            item = self._take()
+            if item is None:
+                return
+            # Es el único hilo de notificaciones: un fallo no puede acabar con él
+            try:
+                self._process(*item)
+            except Exception as e:
+                print(f"Error notificación: {e}", file=sys.stderr)
+
+    def _process(self, title, artist, video_id, thumb_url):
+        icon = None
+        if self.thumbnails:
+            with span("thumbnail_lookup_seconds"):
+                icon = self.thumbnails.get(video_id, thumb_url)
+            with self._cond:
+                # Mientras bajaba la miniatura ya cambió la canción: esta sobra
+                if self._pending is not None:
+                    return
+        with span("notification_seconds"):
+            self._send(title, artist, icon)
+
+    def _send(self, title, artist, icon):
+        # Un reintento con conexión nueva por si el bus se reinició desde la última vez
+        for attempt in range(2):
+            try:
+                if self._bus is None:
+                    self._bus = DBusConnection(self.bus_address)
+                reply = self._bus.call(
+                    "org.freedesktop.Notifications", "/org/freedesktop/Notifications",
+                    "org.freedesktop.Notifications", "Notify", "susssasa{sv}i",
+                    ("YouTube Radio", self._replaces_id, icon or "audio-x-generic",
+                     self.summary, f"{title}\n{artist}", [], {}, -1))
+                # Se esperaba (u id): con otra respuesta se sigue reemplazando la de antes
+                if (isinstance(reply, (tuple, list)) and len(reply) == 1
+                        and isinstance(reply[0], int) and not isinstance(reply[0], bool)):
+                    self._replaces_id = reply[0]
+                return
+            except Exception as e:
+                if self._bus:
+                    self._bus.close()
+                    self._bus = None
+                # Solo un fallo de conexión merece reintento; una respuesta rara, no
+                if not isinstance(e, OSError) or attempt:
+                    break
+        send_notification(title, artist, icon, self._replaces_id, self.summary)
+
+def category_lines(yt):
+    """Categorías en formato 'título ;; sección ;; params JSON' para scripts externos."""
+    categories = yt.get_mood_categories()
+    # Usamos un separador poco común para parsear luego
+    return [f"{item['title']} ;; {section} ;; {json.dumps(item['params'])}"
+            for section, items in categories.items() for item in items]
+
 def list_categories_for_rofi(yt):
     """Imprime categorías en formato simple para scripts externos."""
     try:
-        categories = yt.get_mood_categories()
-        for section, items in categories.items():
-            for item in items:
-                # Usamos un separador poco común para parsear luego
-                print(f"{item['title']} ;; {section} ;; {json.dumps(item['params'])}")
+        for line in category_lines(yt):
+            print(line)
     except Exception as e:
         print(f"Error: {e}")
 
+def search_first(yt, query, index=None):
+    """Primer resultado para una búsqueda: del índice local y, si no está, canciones o vídeos.
+
+    En la API las dos búsquedas salen a la vez; en cuanto hay canciones se devuelve la
+    primera sin esperar a los vídeos (se cancelan si aún no habían empezado).
+    """
+    local = local_lookup(index, query)
+    if local:
+        return local
+    songs = api_pool().submit(yt.search, query, filter="songs")
+    videos = api_pool().submit(yt.search, query, filter="videos")
+    try:
+        results = songs.result()
+    except Exception as e:
+        print(f"Error buscando canciones: {e}")
+        results = None
+    if results:
+        videos.cancel()
+        return results[0]
+    results = videos.result()
+    return results[0] if results else None
+
+class RadioSession:
+    """Una radio en marcha: MPV, cola indexada, teclas multimedia y notificaciones.
+
+    La usan tanto la ejecución normal de radio.py como el demonio (--daemon);
+    el bucle de monitorización corre en su propio hilo. Cada sesión (name) tiene
+    su propio MPV, con su socket y su salida de audio.
+    """
+
+    def __init__(self, yt, thumbnails=None, streams=None, audio=None, audio_ahead=AUDIO_PREFETCH_AHEAD, history=None, recommender=None, track_index=None, endless=False,
+                 name=DEFAULT_SESSION, audio_device=None, media_keys=True):
+        self.yt = yt
+        self.name = name
+        self.socket_path = session_socket_path(name)
+        self.pid_path = self.socket_path + ".pid"
+        self.audio_device = audio_device
+        # Con varias sesiones en un proceso las teclas las gestiona SessionManager
+        self.media_keys = media_keys
+        self.history = history
+        self.recommender = recommender
+        self.track_index = track_index
+        self.thumbnails = thumbnails
+        self.streams = streams
+        self.audio = audio
+        self.audio_ahead = audio_ahead
+        # MPV anterior a 0.38 no admite 'loadfile ... insert-at'
+        self._swap_supported = True
+        self.endless = endless
+        self.player = None
+        self.media_controller = None
+        # Cada sesión reemplaza su propia burbuja (la de la sesión por defecto, la de siempre)
+        if name == DEFAULT_SESSION:
+            self.notifier = NotificationWorker(thumbnails)
+        else:
+            self.notifier = NotificationWorker(thumbnails, replaces_id=0, summary=f"YouTube Radio · {name}")
+        self.track_queue = TrackQueue()
+        self.feeder = None
+        self.now_playing = None
+        self.position = None
+        self._monitor_thread = None
+        self._closing = False
+        self._lock = threading.RLock()
+
+    def start(self):
+        """Arranca (o reutiliza) MPV y empieza a atender sus eventos y las teclas multimedia."""
+        self.player = MpvPlayer(self.socket_path, self.audio_device)
+        startup_mark("MPV listo")
+        claim_player_ownership(self.pid_path, reused=self.player.reused)
+        if self.player.reused:
+            print("Reutilizando MPV activo.")
+        # La cola anterior describía la playlist de otro MPV: empezar una en su generación
+        self.track_queue.retired = True
+        self.track_queue = TrackQueue(generation=self.player.load_generation)
+        self.feeder = None
+
+        # Iniciar control de teclas multimedia
+        if self.media_keys:
+            self.media_controller = MediaKeysController(self.player)
+            self.media_controller.start()
+
+        # Con los streams ya resueltos MPV puede abrir la siguiente entrada antes
+        # de que acabe la actual
+        if self.streams:
+            self.player.ipc.command_async("set_property", "prefetch-playlist", True)
+
+        # Suscribirse antes de cargar la cola para no perder el primer start-file
+        events = self.player.subscribe()
+        self._monitor_thread = threading.Thread(target=self._monitor, args=(events,), daemon=True)
+        self._monitor_thread.start()
+
+    def is_alive(self):
+        return bool(self.player and self.player.is_alive() and self._monitor_thread.is_alive())
+
+    def play(self, tracks, radio_seed=None, mood_params=None, enqueue=False):
+        """Carga tracks en MPV (reemplazando la cola o detrás de ella) y arranca su radio.
+
+        radio_seed: videoId cuya watch playlist se añade en segundo plano.
+        mood_params: categoría de la que sacar más playlists en modo infinito.
+        """
+        with self._lock:
+            if not self.is_alive():
+                if self.media_controller:
+                    self.media_controller.stop()
+                self.start()
+
+            print(f"Cargando {len(tracks)} canciones a la cola...")
+
+            # Sin enqueue la primera canción reemplaza la cola actual de MPV;
+            # con enqueue se añade detrás de lo que ya suena.
+            if enqueue:
+                load_mode = "append-play"
+                if not len(self.track_queue):
+                    self.track_queue = TrackQueue(offset=self.player.get_property("playlist-count") or 0,
+                                                  generation=self.player.load_generation)
+            else:
+                load_mode = "replace"
+                # Bajo edit_lock: una poda o sustitución en curso termina antes del replace
+                with self.track_queue.edit_lock:
+                    self.track_queue.retired = True
+                self.track_queue = TrackQueue()
+                self.feeder = None
+                self.position = None
+            track_queue = self.track_queue
+
+            # Una sola canción es la que pidió el usuario: esa suena aunque se repita
+            if len(tracks) > 1:
+                tracks = rank_by_history(tracks, self.history)
+            with span("queue_load_seconds"):
+                urls = [self._local_or(track_queue, url) for url in map(track_queue.add, tracks) if url]
+                self.player.load_urls(urls, mode=load_mode, generation=track_queue.generation)
+            startup_mark("primera canción enviada a MPV")
+            if self.thumbnails:
+                self.thumbnails.prefetch(track_queue.upcoming(track_queue.offset - 1, THUMB_PREFETCH_AHEAD + 1))
+
+            if self.endless and self.feeder is None:
+                # El feeder pide también la radio de la semilla: la cola empieza casi vacía
+                self.feeder = RadioFeeder(self.yt, self.player, track_queue, seed_video_id=radio_seed, mood_params=mood_params, history=self.history, recommender=self.recommender)
+                self.feeder.mark_seen(tracks)
+                self.feeder.on_position(track_queue.offset)
+            else:
+                if self.feeder:
+                    self.feeder.mark_seen(tracks)
+                if radio_seed:
+                    threading.Thread(target=append_watch_playlist, args=(self.yt, self.player, track_queue, radio_seed, self.history, self.recommender), daemon=True).start()
+            self._preresolve()
+
+    def status(self):
+        title, artist, video_id, _ = describe_track(self.now_playing, None)
+        alive = self.is_alive()
+        return {
+            "session": self.name,
+            "audio_device": self.audio_device,
+            "playing": alive,
+            "title": title,
+            "artist": artist if self.now_playing else None,
+            "videoId": video_id,
+            "paused": self.player.get_property("pause") if alive else None,
+            "position": self.position,
+            "queue": len(self.track_queue),
+            "remaining": self.track_queue.remaining(self.position),
+        }
+
+    def wait(self):
+        """Bloquea hasta que MPV se cierra."""
+        if self._monitor_thread:
+            self._monitor_thread.join()
+
+    def close(self, quit_player=True, keep_stores=False):
+        """Para las teclas multimedia y cierra MPV (o lo deja sonando si quit_player=False).
+
+        keep_stores: no cerrar historial, recomendador ni índice (los comparten otras sesiones).
+        """
+        self._closing = True
+        if self.media_controller:
+            self.media_controller.stop()
+        if not keep_stores:
+            self.flush_stores()
+        self.notifier.close()
+        if self.player:
+            if quit_player:
+                self.player.close()
+            else:
+                self.player.detach()
+
+    def flush_stores(self):
+        """Guarda lo pendiente del historial, del recomendador y del índice de canciones (al salir)."""
+        for store in (self.history, self.recommender, self.track_index):
+            if store:
+                store.close()
+
+    def _monitor(self, events):
+        # Bucle de monitorización: MPV empuja los cambios, el hilo duerme entre canciones
+        curr_path = None
+        curr_title = None
+        announced = True
+        while True:
+            msg = events.get()
+            event = msg.get("event")
+
+            if event in ("disconnected", "shutdown"):
+                if not self._closing:
+                    print("MPV se cerró inesperadamente.")
+                return
+            elif event == "start-file":
+                # Nueva entrada: notificar aunque se repita la misma pista
+                announced = False
+                curr_path = curr_title = None
+                continue
+            elif event == "end-file":
+                if msg.get("reason") == "error":
+                    print(f"No se pudo reproducir la entrada (error: {msg.get('file_error', 'desconocido')})")
+                continue
+            elif event != "property-change":
+                continue
+
+            name = msg.get("name")
+            data = msg.get("data")
+            if name == "playlist-pos":
+                self.position = data
+                if self.feeder:
+                    self.feeder.on_position(data)
+                self._preresolve()
+            elif name == "path":
+                curr_path = data
+            elif name == "media-title":
+                # Si es un dict (metadatos internos de mpv/ytdl aún cargando), ignorar
+                curr_title = data if isinstance(data, str) else None
+
+            if announced or not isinstance(curr_path, str):
+                continue
+
+            found_track = self.track_queue.resolve(path=curr_path, pos=self.position)
+            if not found_track and not curr_title:
+                # Entrada ajena a esta cola: esperar al media-title de yt-dlp
+                continue
+
+            announced = True
+            self.now_playing = found_track or {'title': curr_title}
+            if self.history and found_track:
+                self.history.record(found_track)
+            display_title, display_artist, video_id_track, thumb_url = describe_track(found_track, curr_title)
+            label = "" if self.name == DEFAULT_SESSION else f"[{self.name}] "
+            print(f"\n>> {label}{display_title} - {display_artist}")
+
+            # El hilo de notificaciones se queda solo con la última canción
+            self.notifier.notify(display_title, display_artist, video_id_track, thumb_url)
+
+            # Mientras suena esta, ir bajando las miniaturas de las siguientes
+            if self.thumbnails:
+                self.thumbnails.prefetch(self.track_queue.upcoming(self.position, THUMB_PREFETCH_AHEAD))
+
+    def _local_or(self, track_queue, url):
+        # Si el audio ya está en disco, MPV lo abre directamente
+        track = track_queue.by_path(url)
+        path = self.audio.get(track['videoId']) if self.audio and track else None
+        if not path:
+            return url
+        track_queue.set_stream(track['videoId'], path)
+        return path
+
+    def _preresolve(self):
+        # Preparar ya las próximas pistas para que el cambio sea inmediato: audio
+        # en disco (incluida la actual, para repeticiones) y, mientras tanto, streams
+        if not isinstance(self.position, int):
+            return
+        track_queue = self.track_queue
+        if self.audio:
+            current = track_queue.by_position(self.position)
+            tracks = ([current] if current else []) + track_queue.upcoming(self.position, self.audio_ahead)
+            self.audio.prefetch([t['videoId'] for t in tracks], self._swap_stream)
+        if self.streams and self._swap_supported:
+            upcoming = track_queue.upcoming(self.position, STREAM_RESOLVE_AHEAD)
+            pending = [t['videoId'] for t in upcoming if not track_queue.has_stream(t['videoId'])]
+            if pending:
+                self.streams.prefetch(pending, self._swap_stream)
+
+    def _swap_stream(self, video_id, url):
+        """Sustituye en MPV la entrada de YouTube de video_id por su stream ya resuelto."""
+        track_queue = self.track_queue
+        with track_queue.edit_lock:
+            # Cola reemplazada mientras se resolvía: sus posiciones ya no valen
+            if track_queue.retired:
+                return
+            pos = track_queue.position_of(video_id, self.position)
+            current = track_queue.stream_of(video_id)
+            if pos is None or current == url or not self._swap_supported:
+                return
+            # Un fichero local solo se sustituye por otro; un stream, por el fichero
+            if current and (not current.startswith("http") or url.startswith("http")):
+                return
+            try:
+                # El stream entra justo delante de la entrada original, que se retira
+                self.player.command("loadfile", url, "insert-at", pos)
+            except MpvError as e:
+                if not self.player.ipc.connected:
+                    return
+                self._swap_supported = False
+                print(f"MPV no admite insert-at ({e}); cada pista se resolverá al sonar.", file=sys.stderr)
+                return
+            self.player.ipc.command_async("playlist-remove", pos + 1)
+            track_queue.set_stream(video_id, url)
+
+class SessionManager:
+    """Varias radios independientes (zonas) en un solo proceso.
+
+    Cada sesión tiene su MPV (con su --audio-device), su socket, su cola y su
+    notificación; el cliente de YouTube Music, las cachés, el historial, el
+    recomendador y el índice de canciones se comparten. Un único controlador de
+    teclas multimedia manda a la sesión seleccionada.
+    """
+
+    def __init__(self, yt, thumbnails=None, streams=None, audio=None, audio_ahead=AUDIO_PREFETCH_AHEAD, history=None, recommender=None, track_index=None, endless=False):
+        self.yt = yt
+        self.thumbnails = thumbnails
+        self.streams = streams
+        self.audio = audio
+        self.audio_ahead = audio_ahead
+        self.history = history
+        self.recommender = recommender
+        self.track_index = track_index
+        self.endless = endless
+        self.sessions = {}
+        self.selected = DEFAULT_SESSION
+        self._lock = threading.Lock()
+        # Las teclas llaman a send_command: la sesión seleccionada en cada momento
+        self.media_controller = MediaKeysController(self)
+        self._keys_started = False
+
+    def get(self, name=None, audio_device=None):
+        """Sesión name, creándola si no existe (audio_device solo cuenta al crearla o cambiarla)."""
+        name = name or DEFAULT_SESSION
+        with self._lock:
+            session = self.sessions.get(name)
+            if session is None:
+                session = RadioSession(self.yt, thumbnails=self.thumbnails, streams=self.streams, audio=self.audio,
+                                       audio_ahead=self.audio_ahead, history=self.history, recommender=self.recommender,
+                                       track_index=self.track_index, endless=self.endless,
+                                       name=name, audio_device=audio_device, media_keys=False)
+                self.sessions[name] = session
+            elif audio_device and audio_device != session.audio_device:
+                session.audio_device = audio_device
+                if session.is_alive():
+                    session.player.ipc.command_async("set_property", "audio-device", audio_device)
+            if not self._keys_started:
+                self._keys_started = True
+                self.media_controller.start()
+        return session
+
+    def find(self, name=None):
+        """Sesión ya existente; LookupError si no la hay."""
+        session = self.sessions.get(name or DEFAULT_SESSION)
+        if session is None:
+            raise LookupError(f"No existe la sesión '{name}'")
+        return session
+
+    def select(self, name):
+        """Dirige las teclas multimedia a la sesión name."""
+        self.selected = self.find(name).name
+
+    def send_command(self, command):
+        session = self.sessions.get(self.selected)
+        if session and session.is_alive():
+            session.player.send_command(command)
+
+    def status(self):
+        return [dict(session.status(), selected=name == self.selected) for name, session in list(self.sessions.items())]
+
+    def detach_taken_over(self):
+        """Suelta (sin cerrar su MPV) las sesiones cuyo reproductor ha reclamado otro proceso."""
+        with self._lock:
+            taken = [name for name, session in self.sessions.items()
+                     if session.pid_path in _claimed_pid_paths and not is_player_owner(session.pid_path)]
+            sessions = [self.sessions.pop(name) for name in taken]
+        for session in sessions:
+            print(f"Otra instancia ha tomado el control de la sesión '{session.name}'.")
+            session.close(quit_player=False, keep_stores=True)
+            release_player_ownership(session.pid_path)
+
+    def close_session(self, name):
+        """Cierra la sesión name (su MPV incluido) sin tocar las demás."""
+        with self._lock:
+            session = self.sessions.pop(name or DEFAULT_SESSION, None)
+        if session is None:
+            raise LookupError(f"No existe la sesión '{name}'")
+        session.close(keep_stores=True)
+        release_player_ownership(session.pid_path)
+
+    def close(self):
+        """Cierra todas las sesiones y guarda lo pendiente de lo compartido."""
+        self.media_controller.stop()
+        for name in list(self.sessions):
+            self.close_session(name)
+        self.flush_stores()
+
+    # Los mismos atributos history/recommender/track_index que una sesión suelta
+    flush_stores = RadioSession.flush_stores
+
+class RadioDaemon:
+    """Demonio de control: mantiene la radio y un YTMusic caliente entre lanzamientos.
+
+    Atiende peticiones JSON de una línea por un socket Unix y responde con
+    {"ok": true, "data": ...} o {"ok": false, "error": "..."}. Las peticiones
+    de reproducción van a la sesión "session" (por defecto, la de siempre).
+    """
+
+    def __init__(self, yt, sessions, socket_path=None):
+        self.yt = yt
+        self.sessions = sessions
+        self.socket_path = socket_path or DAEMON_SOCKET_PATH
+        self.running = False
+        self._server = None
+
+    def serve_forever(self):
+        if daemon_request({"cmd": "ping"}, socket_path=self.socket_path) is not None:
+            raise Exception("Ya hay un demonio de radio en marcha")
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        # Solo el usuario que lo lanzó puede controlar la radio
+        os.chmod(self.socket_path, 0o600)
+        self._server.listen()
+        self.running = True
+        pid_path = self.socket_path + ".pid"
+        with open(pid_path, "w") as f:
+            f.write(str(os.getpid()))
+
+        # Construir ya el cliente YTMusic, el clasificador y el índice de prompts, para que
+        # la primera petición no los pague
+        threading.Thread(target=lambda: (self.yt.client, prompt_matcher(), prompt_index(self.yt, with_tracks=True)), daemon=True).start()
+
+        print(f"Demonio de radio escuchando en {self.socket_path}")
+        try:
+            while self.running:
+                try:
+                    conn, _ = self._server.accept()
+                except OSError:
+                    if not self.running:
+                        break
+                    raise
+                threading.Thread(target=self._serve_connection, args=(conn,), daemon=True).start()
+        finally:
+            self._server.close()
+            for path in (self.socket_path, pid_path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _serve_connection(self, conn):
+        with conn, conn.makefile("rwb") as stream:
+            for line in stream:
+                try:
+                    request = json.loads(line)
+                    response = {"ok": True, "data": self.handle_request(request)}
+                except Exception as e:
+                    response = {"ok": False, "error": str(e)}
+                stream.write((json.dumps(response) + "\n").encode("utf-8"))
+                stream.flush()
+
+    def handle_request(self, request):
+        cmd = request.get("cmd")
+        enqueue = bool(request.get("enqueue"))
+        name = request.get("session")
+
+        if cmd == "ping":
+            return "pong"
+        if cmd == "status":
+            # La sesión por defecto siempre responde, aunque aún no haya sonado nada
+            return (self.sessions.find(name) if name else self.sessions.get()).status()
+        if cmd == "sessions":
+            return self.sessions.status()
+        if cmd == "select":
+            self.sessions.select(name)
+            return None
+        if cmd == "close_session":
+            self.sessions.close_session(name)
+            return None
+        if cmd == "list_categories":
+            return category_lines(self.yt)
+        if cmd == "local_search":
+            return list(local_search(self.yt, self.sessions.track_index, request.get("query")))
+
+        if cmd in ("play_prompt", "play_search", "enqueue", "play_category"):
+            session = self.sessions.get(name, request.get("audio_device"))
+        if cmd == "play_prompt":
+            prompt = request.get("query")
+            if not prompt:
+                raise ValueError("Falta 'query'")
+            tracks, first, params = prompt_radio(self.yt, prompt, with_tracks=True)
+            if tracks:
+                session.play(tracks, mood_params=params, enqueue=enqueue)
+                return {"title": f"radio de categoría ({len(tracks)} canciones)", "tracks": len(tracks)}
+            if not first:
+                raise LookupError(f"Sin resultados para '{prompt}'")
+            session.play([first], radio_seed=first['videoId'], enqueue=enqueue)
+            return {"title": first.get('title'), "videoId": first['videoId']}
+        if cmd in ("play_search", "enqueue"):
+            query = request.get("query")
+            if not query:
+                raise ValueError("Falta 'query'")
+            first = search_first(self.yt, query, self.sessions.track_index)
+            if not first:
+                raise LookupError(f"Sin resultados para '{query}'")
+            session.play([first], radio_seed=first['videoId'], enqueue=enqueue or cmd == "enqueue")
+            return {"title": first.get('title'), "videoId": first['videoId']}
+        if cmd == "play_category":
+            params = request.get("params")
+            if not params:
+                raise ValueError("Falta 'params'")
+            tracks = get_radio_from_mood(self.yt, params)
+            if not tracks:
+                raise LookupError("La categoría no devolvió canciones")
+            session.play(tracks, mood_params=params, enqueue=enqueue)
+            return {"tracks": len(tracks)}
+        if cmd in ("next", "prev", "pause"):
+            session = self.sessions.find(name)
+            if not session.is_alive():
+                raise RuntimeError("No hay nada sonando")
+            command = {"next": "playlist-next", "prev": "playlist-prev", "pause": "cycle"}[cmd]
+            args = [command, "pause"] if cmd == "pause" else [command]
+            session.player.command(*args)
+            return None
+        if cmd == "quit":
+            self.running = False
+            self.sessions.close()
+            # Desbloquear accept() para que serve_forever termine
+            self._server.shutdown(socket.SHUT_RDWR)
+            return None
+        raise ValueError(f"Comando desconocido: {cmd}")
+
+def daemon_request(request, socket_path=DAEMON_SOCKET_PATH, timeout=30):
+    """Envía una petición al demonio; devuelve su respuesta o None si no está en marcha."""
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with sock.makefile("rb") as stream:
+            line = stream.readline()
+        return json.loads(line) if line else None
+    except (OSError, ValueError):
+        return None
+    finally:
+        sock.close()
+
+def forward_to_daemon(args):
+    """Reenvía el modo pedido al demonio si está en marcha; True si se encargó él."""
+    if args.mode == 'list-categories':
+        request = {"cmd": "list_categories"}
+    elif args.mode == 'local-search' and args.query:
+        # Sin query el índice se lee aquí mismo: no hace falta pasar todo por el socket
+        request = {"cmd": "local_search", "query": args.query}
+    elif args.mode in ('search', 'prompt') and args.query:
+        request = {"cmd": f"play_{args.mode}", "query": args.query, "enqueue": args.enqueue}
+    elif args.mode == 'category' and args.params:
+        request = {"cmd": "play_category", "params": args.params, "enqueue": args.enqueue}
+    elif args.focus and not args.mode:
+        request = {"cmd": "select"}
+    else:
+        return False
+    request.update(session=args.session, audio_device=args.audio_device)
+
+    response = daemon_request(request)
+    if response is None:
+        return False
+    if not response.get("ok"):
+        print(f"Error del demonio: {response.get('error')}")
+    elif args.mode in ('list-categories', 'local-search'):
+        print("\n".join(response["data"]))
+    elif args.mode == 'category':
+        print(f"Cargando {response['data']['tracks']} canciones en el demonio.")
+    elif args.mode:
+        print(f"Seleccionado: {response['data']['title']}")
+    if response.get("ok") and args.focus and args.mode:
+        daemon_request({"cmd": "select", "session": args.session})
+    return True
+
 def main():
-    check_dependencies()
-    
     # Configurar argumentos
     parser = argparse.ArgumentParser(description="YouTube Music Radio Player")
-    parser.add_argument("--mode", choices=['search', 'prompt', 'category', 'list-categories'], help="Modo de operación")
+    parser.add_argument("--mode", choices=['search', 'prompt', 'category', 'list-categories', 'local-search'], help="Modo de operación")
     parser.add_argument("--query", help="Texto de búsqueda o prompt")
     parser.add_argument("--params", help="Parámetros JSON para categorías")
+    parser.add_argument("--enqueue", action="store_true", help="Añadir a la cola del reproductor activo en lugar de reemplazarla")
+    parser.add_argument("--endless", action="store_true", help="Radio infinita: seguir añadiendo canciones cuando la cola se agote")
+    parser.add_argument("--no-cache", action="store_true", help="No usar la caché en disco de la API de YouTube Music")
+    parser.add_argument("--profile-startup", action="store_true", help="Mostrar en stderr los tiempos de importación e inicialización")
+    parser.add_argument("--prefetch-audio", nargs="?", type=int, const=AUDIO_PREFETCH_AHEAD, metavar="K", help=f"Descargar el audio de la canción actual y las K siguientes (por defecto {AUDIO_PREFETCH_AHEAD}) a {AUDIO_CACHE_DIR}")
+    parser.add_argument("--metrics", metavar="FICHERO", help="Medir llamadas a YouTube Music, MPV y HTTP y volcar los histogramas en FICHERO al salir o con SIGUSR1 (JSON si acaba en .json, si no formato Prometheus)")
+    parser.add_argument("--daemon", action="store_true", help=f"Quedarse en segundo plano atendiendo peticiones en {DAEMON_SOCKET_PATH}")
+    parser.add_argument("--session", default=DEFAULT_SESSION, metavar="NOMBRE", help="Radio (zona) a la que va la petición; cada una tiene su propio MPV")
+    parser.add_argument("--audio-device", metavar="DISPOSITIVO", help="Salida de audio del MPV de la sesión (ver mpv --audio-device=help)")
+    parser.add_argument("--focus", action="store_true", help="Con el demonio en marcha, dirigir las teclas multimedia a --session")
+    # Uso interno: refresco desligado que lanza --mode list-categories
+    parser.add_argument("--refresh-cache", metavar="JSON", help=argparse.SUPPRESS)
     args = parser.parse_args()
+    startup_mark("argparse")
+    if args.refresh_cache:
+        CachedYTMusic(open_api_cache()).refresh_now(json.loads(args.refresh_cache))
+        return
+    if args.metrics:
+        enable_metrics(args.metrics)
+    try:
+        session_socket_path(args.session)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
+    # Con el demonio en marcha este proceso es solo un cliente ligero
+    if not args.daemon and forward_to_daemon(args):
+        startup_mark("petición atendida por el demonio")
+        if args.profile_startup:
+            print_startup_profile()
+        return
+    if args.focus and not args.mode and not args.daemon:
+        print("Error: --focus requiere el demonio en marcha (--daemon)")
+        return
+
+    yt = CachedYTMusic(None if args.no_cache else open_api_cache())
+    startup_mark("caché de la API")
+
+    # Desde aquí toda playlist que llegue de la API alimenta el recomendador y el
+    # índice locales (listar categorías no los necesita y debe arrancar al momento)
+    track_index = None if args.mode == 'list-categories' and not args.daemon else open_track_index(yt, background=args.mode != 'local-search')
+    recommender = None if args.mode in ('list-categories', 'local-search') and not args.daemon else open_recommender(yt)
 
-    yt = YTMusic()
+    if args.daemon:
+        run_daemon(yt, args, recommender, track_index)
+        return
+
+    # Búsqueda local para el menú: imprime coincidencias (o todo el índice) y sale
+    if args.mode == 'local-search':
+        try:
+            for line in local_search(yt, track_index, args.query):
+                print(line)
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # El menú se cerró antes de leerlo todo
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            os.close(devnull)
+        except Exception as e:
+            print(f"Error: {e}", file=sys.stderr)
+        finally:
+            if track_index:
+                track_index.close()
+        startup_mark("búsqueda local")
+        if args.profile_startup:
+            print_startup_profile()
+        return
     
-    # Modo listado para Rofi (solo imprime y sale)
+    # Modo listado para Rofi (solo imprime y sale): si la caché estaba
+    # caducada, la refresca un proceso aparte y el menú sale ya
     if args.mode == 'list-categories':
+        yt.deferred_refreshes = []
         list_categories_for_rofi(yt)
+        startup_mark("categorías listadas")
+        if args.profile_startup:
+            print_startup_profile()
+        yt.refresh_detached()
         return
 
+    check_dependencies()
+
     tracks = []
     video_id = None
+    seed_track = None
+    mood_params = None
     
     # Lógica de selección (Interactiva vs Argumentos)
     if args.mode:
@@ -515,26 +3811,20 @@ def main():
                 print("Error: --query requerido para search")
                 return
             print(f"Buscando '{args.query}'...")
-            results = yt.search(args.query, filter="songs")
-            if not results:
-                results = yt.search(args.query, filter="videos")
-            if results:
-                first = results[0]
+            first = search_first(yt, args.query, track_index)
+            if first:
                 video_id = first['videoId']
+                seed_track = first
                 print(f"Seleccionado: {first['title']}")
                 
         elif args.mode == 'prompt':
             if not args.query:
                 print("Error: --query requerido para prompt")
                 return
-            analyzed = analyze_music_prompt(args.query)
-            print(f"Interpretado: {analyzed}")
-            results = yt.search(analyzed, filter="songs")
-            if not results:
-                results = yt.search(analyzed, filter="videos")
-            if results:
-                first = results[0]
+            tracks, first, mood_params = prompt_radio(yt, args.query)
+            if first:
                 video_id = first['videoId']
+                seed_track = first
                 
         elif args.mode == 'category':
             if not args.params:
@@ -545,6 +3835,7 @@ def main():
             mood_tracks = get_radio_from_mood(yt, args.params)
             if mood_tracks:
                 tracks = mood_tracks
+                mood_params = args.params
             
     else:
         # --- MODO INTERACTIVO (CLI ORIGINAL) ---
@@ -559,40 +3850,49 @@ def main():
         if mode_choice == "1":
             query = input("¿Qué grupo o estilo quieres escuchar?: ").strip()
             if not query: return
+            # Con el demonio en marcha la radio suena en él
+            args.mode, args.query = 'search', query
+            if forward_to_daemon(args):
+                return
             print(f"Buscando '{query}'...")
-            results = yt.search(query, filter="songs")
-            if not results: results = yt.search(query, filter="videos")
-            if not results:
+            first = search_first(yt, query, track_index)
+            if not first:
                 print("No se encontró nada.")
                 return
-            first = results[0]
             video_id = first['videoId']
+            seed_track = first
             print(f"Iniciando con: {first['title']}")
             
         elif mode_choice == "2":
             prompt = input("Describe el tipo de música: ").strip()
             if not prompt: return
-            analyzed_query = analyze_music_prompt(prompt)
-            print(f"\nInterpretando como: '{analyzed_query}'")
-            results = yt.search(analyzed_query, filter="songs")
-            if not results: results = yt.search(analyzed_query, filter="videos")
-            if not results:
+            args.mode, args.query = 'prompt', prompt
+            if forward_to_daemon(args):
+                return
+            tracks, first, mood_params = prompt_radio(yt, prompt)
+            if not tracks and not first:
                 print("No se encontró nada.")
                 return
-            first = results[0]
-            video_id = first['videoId']
+            if first:
+                video_id = first['videoId']
+                seed_track = first
             
         elif mode_choice == "3":
             selected_category = show_mood_categories(yt)
             if not selected_category: return
+            args.mode, args.params = 'category', selected_category['params']
+            if forward_to_daemon(args):
+                return
             print(f"\nObteniendo playlists de '{selected_category['title']}'...")
             mood_tracks = get_radio_from_mood(yt, selected_category['params'])
             if mood_tracks:
                 tracks = mood_tracks
+                mood_params = selected_category['params']
             else:
                 results = yt.search(selected_category['title'], filter="songs")
                 if results:
                     video_id = results[0]['videoId']
+                    seed_track = results[0]
         else:
             print("Opción no válida.")
             return
@@ -602,141 +3902,88 @@ def main():
         print("No se pudo obtener música. Saliendo.")
         return
 
-    player = None
-    media_controller = None
-    try:
-        # Iniciar player
-        player = MpvPlayer()
-        
-        # Iniciar control de teclas multimedia
-        media_controller = MediaKeysController(player)
-        media_controller.start()
-        
-        # Si no obtuvimos tracks del modo categorías, obtener watch playlist
-        if not tracks and video_id:
-            watch_playlist = yt.get_watch_playlist(videoId=video_id, limit=50)
-            tracks = watch_playlist.get('tracks', [])
-        
-        # Mapa para guardar metadatos {videoId: track_obj}
-        # MPV nos dirá qué videoId está tocando (filename o media-title)
-        # pero es mejor llevar el control nosotros.
-        track_map = {}
-        
-        # Cargar cola inicial
-        if not isinstance(tracks, list):
-            print("Error: formato de tracks inesperado")
-            return
+    # Si no obtuvimos tracks del modo categorías, la canción elegida suena ya
+    # y su watch playlist se pide en paralelo y se añade cuando llegue
+    radio_seed = None
+    if not tracks and video_id:
+        tracks = [seed_track]
+        radio_seed = video_id
 
-        print(f"Cargando {len(tracks)} canciones a la cola...")
+    # Cargar cola inicial
+    if not isinstance(tracks, list):
+        print("Error: formato de tracks inesperado")
+        return
+
+    session = open_session(yt, args, recommender, track_index)
+    try:
+        # Iniciar player (o reutilizar el MPV que ya está sonando)
+        signal.signal(signal.SIGTERM, _on_sigterm)
+        session.start()
+        session.play(tracks, radio_seed=radio_seed, mood_params=mood_params, enqueue=args.enqueue)
+        if args.profile_startup:
+            print_startup_profile()
 
-        for track in tracks:
-            if not isinstance(track, dict): continue
-            
-            vid = track.get('videoId')
-            title = track.get('title')
-            
-            # Manejar None values
-            if not vid:
-                continue
-                
-            # Asegurar que vid y title sean usables como claves (strings)
-            if not isinstance(vid, str):
-                vid = str(vid)
-            
-            if title is None:
-                title = "Unknown"
-            elif not isinstance(title, str):
-                # A veces puede venir como objeto complejo o lista, aunque es raro en esta llamada
-                title = str(title)
-            
-            # Construir URL completa
-            url = f"https://www.youtube.com/watch?v={vid}"
-            
-            # Guardar metadatos para uso posterior
-            track_map[vid] = track
-            track_map[title] = track # Por si acaso MPV devuelve título
-            
-            # Añadir a MPV
-            player.add_to_playlist(url)
-            
-        # Comenzar reproducción (si estaba idle)
-        player.send_command({"command": ["playlist-play-index", 0]})
-        
         print("Reproduciendo. Controla con teclas multimedia.")
         print("Presiona Ctrl+C para salir.")
-        
-        # Bucle de monitorización
-        last_title = ""
-        while True:
-            # Obtener título actual o media-title
-            curr_title = player.get_property("media-title")
-            
-            # Si es un dict (metadatos internos de mpv/ytdl aún cargando), ignorar
-            if not isinstance(curr_title, str):
-                time.sleep(0.5)
-                continue
-            
-            # A veces media-title es la URL si yt-dlp no ha cargado metadata aún
-            # O yt-dlp pone el título real del video.
-            
-            if curr_title and curr_title != last_title:
-                # Ha cambiado la canción
-                last_title = curr_title
-                
-                # Intentar buscar metadatos enriquecidos en nuestro mapa
-                # El título de MPV puede diferir ligeramente del de YTMusic
-                # Buscamos coincidencia aproximada o directa
-                found_track = None
-                
-                # Intento 1: Coincidencia exacta de título
-                if curr_title in track_map:
-                    found_track = track_map[curr_title]
-                else:
-                    # Intento 2: Buscar por substring
-                    for k, v in track_map.items():
-                        if k in curr_title or curr_title in k:
-                            found_track = v
-                            break
-                
-                display_title = curr_title
-                display_artist = "Radio"
-                video_id_track = None
-                thumb_url = None
-                
-                if found_track:
-                    display_title = found_track.get('title', curr_title)
-                    artists = found_track.get('artists', [])
-                    if artists:
-                        display_artist = artists[0]['name']
-                    
-                    video_id_track = found_track.get('videoId')
-                    if found_track.get('thumbnails'):
-                        thumb_url = get_best_thumbnail(found_track['thumbnails'])
-                
-                print(f"\n>> {display_title} - {display_artist}")
-                
-                # Notificación en hilo aparte para no bloquear
-                threading.Thread(target=send_notification, args=(display_title, display_artist, video_id_track, thumb_url)).start()
-                
-            time.sleep(1)
-            
-            # Verificar si MPV sigue vivo
-            if player.process.poll() is not None:
-                print("MPV se cerró inesperadamente.")
-                break
+        session.wait()
 
     except KeyboardInterrupt:
         print("\nSaliendo...")
-        if media_controller:
-            media_controller.stop()
-        if player:
-            player.close()
+        session.close()
+    except PlayerTakenOver:
+        # Otro lanzamiento controla ahora MPV: salir sin cortar la música
+        print("\nOtra instancia ha tomado el control del reproductor.")
+        session.close(quit_player=False)
+    except PlayerInUse as e:
+        print(f"Error: {e}.")
+        session.close(quit_player=False)
+    except Exception as e:
+        print(f"Error: {e}")
+        session.close()
+    finally:
+        release_player_ownership(session.pid_path)
+        # MPV pudo cerrarse por su cuenta: no perder las últimas escuchas
+        session.flush_stores()
+
+def session_options(args, recommender=None, track_index=None):
+    """Cachés y almacenes que permiten los argumentos y el sistema (comunes a todas las sesiones)."""
+    audio = open_audio_cache() if args.prefetch_audio is not None else None
+    return dict(thumbnails=open_thumbnail_cache(), streams=open_stream_resolver(),
+                audio=audio, audio_ahead=args.prefetch_audio or 0, history=open_history(),
+                recommender=recommender, track_index=track_index, endless=args.endless)
+
+def open_session(yt, args, recommender=None, track_index=None):
+    """RadioSession de --session con las cachés que permiten los argumentos y el sistema."""
+    # Sin demonio cada --session es un proceso aparte: solo la sesión por defecto
+    # escucha las teclas multimedia, o una pulsación saltaría en todas las zonas
+    return RadioSession(yt, name=args.session, audio_device=args.audio_device,
+                        media_keys=(args.session == DEFAULT_SESSION),
+                        **session_options(args, recommender, track_index))
+
+def run_daemon(yt, args, recommender=None, track_index=None):
+    """Modo --daemon: las radios viven aquí y los lanzamientos solo le mandan peticiones."""
+    check_dependencies()
+    sessions = SessionManager(yt, **session_options(args, recommender, track_index))
+    if args.audio_device:
+        sessions.get(args.session, args.audio_device)
+    daemon = RadioDaemon(yt, sessions)
+
+    def on_sigterm(signum, frame):
+        # Un relevo solo afecta a la sesión reclamada: el demonio sigue atendiendo
+        if not any(s.pid_path in _claimed_pid_paths and not is_player_owner(s.pid_path) for s in list(sessions.sessions.values())):
+            raise KeyboardInterrupt
+        threading.Thread(target=sessions.detach_taken_over, daemon=True).start()
+
+    try:
+        signal.signal(signal.SIGTERM, on_sigterm)
+        daemon.serve_forever()
+    except (KeyboardInterrupt, PlayerTakenOver):
+        print("\nSaliendo...")
     except Exception as e:
         print(f"Error: {e}")
-        if media_controller:
-            media_controller.stop()
-        if player:
-            player.close()
+    finally:
+        # Cierra las sesiones que queden y guarda historial, recomendador e índice
+        sessions.close()
 
 if __name__ == "__main__":
     main()
@@ -28,7 +28,9 @@ fi
 
 case "$CHOICE" in
   "1) Buscar por artista/canción")
-    QUERY="$(${WOFI_CMD} -dmenu -p '¿Qué grupo o estilo quieres escuchar?' </dev/null 2>/dev/null || true)"
+    # Stream the local track index into wofi, which filters it as the user types;
+    # free text that matches no line is searched as before
+    QUERY="$("$PY_CMD" "$RADIO" --mode local-search 2>/dev/null | ${WOFI_CMD} -dmenu -i -p '¿Qué grupo o estilo quieres escuchar?' 2>/dev/null || true)"
     if [ -n "$QUERY" ]; then
       "$PY_CMD" "$RADIO" --mode search --query "$QUERY"
     fi